@@ -1,7 +1,20 @@
 from django.contrib import admin
-from .models import Room, Membership, Message, FileAttachment
+from .models import (
+    Room,
+    RoomKey,
+    UserPublicKey,
+    MemberRoomKey,
+    Membership,
+    Message,
+    AttachmentBlob,
+    FileAttachment,
+)
 # Register your models here.
 admin.site.register(Room)
+admin.site.register(RoomKey)
+admin.site.register(UserPublicKey)
+admin.site.register(MemberRoomKey)
 admin.site.register(Membership)
 admin.site.register(Message)
+admin.site.register(AttachmentBlob)
 admin.site.register(FileAttachment)
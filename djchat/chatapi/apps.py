@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ChatapiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatapi'
+
+    def ready(self):
+        if settings.CHAT_WARM_STARTUP:
+            from .startup import warm
+
+            warm()
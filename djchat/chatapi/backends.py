@@ -0,0 +1,38 @@
+"""
+Authentication backend checking passwords on the hashing pool (passwords.py).
+
+Django's ModelBackend verifies in a thread of the ASGI worker on the async
+path. PooledModelBackend does the same lookups and checks but awaits the
+hash on the pool, so ``aauthenticate()`` keeps AUTHENTICATION_BACKENDS and the
+``user_login_failed`` signal without a login storm tying up the worker.
+"""
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+from .passwords import ahash_password, averify_password
+
+UserModel = get_user_model()
+
+
+class PooledModelBackend(ModelBackend):
+    async def aauthenticate(self, request, username=None, password=None, **kwargs):
+        """Raises passwords.HashingBusy when the pool is full."""
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = await UserModel._default_manager.aget_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            user = None
+        if user is None or not user.has_usable_password():
+            # hash anyway so unknown usernames take as long as known ones
+            await ahash_password(password)
+            return None
+        valid, upgraded = await averify_password(password, user.password)
+        if not valid:
+            return None
+        if upgraded:
+            user.password = upgraded
+            await user.asave(update_fields=["password"])
+        return user if self.user_can_authenticate(user) else None
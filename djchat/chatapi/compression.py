@@ -0,0 +1,152 @@
+"""
+Message body compression, applied before encryption.
+
+Chat text is short and repetitive, so message bodies are zstd-compressed
+before AES-GCM, with a trained dictionary when the room (or the whole server)
+has one. Encoded bodies start with a format byte from 0xF8-0xFF, a range that
+never occurs in UTF-8: a body starting with anything else is a raw UTF-8 body
+from before compression (or one that did not get smaller), so old rows stay
+readable as they are.
+
+zstandard is optional (`pip install zstandard`). Without it new bodies are
+stored raw; reading compressed bodies then fails.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import F, Q
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMAT_ZSTD = 0xFF
+# followed by the 4-byte big-endian CompressionDictionary id
+FORMAT_ZSTD_DICT = 0xFE
+
+# how long a process keeps using a room's dictionary before checking for a newer one
+ACTIVE_DICTIONARY_TTL = 300
+
+_dictionaries = {}  # CompressionDictionary id -> ZstdCompressionDict (immutable)
+_active = {}  # room id (None: global) -> (expires, dictionary id or None)
+_local = threading.local()  # compressor objects are not thread-safe
+
+
+def available() -> bool:
+    return zstandard is not None and settings.CHAT_COMPRESSION
+
+
+def _params():
+    # no magic number, checksum or dict id in the frame: the format byte and
+    # AES-GCM already cover those, and chat messages are short
+    return zstandard.ZstdCompressionParameters.from_level(
+        settings.CHAT_COMPRESSION_LEVEL,
+        format=zstandard.FORMAT_ZSTD1_MAGICLESS,
+        write_checksum=0,
+        write_dict_id=0,
+        write_content_size=1,
+    )
+
+
+def load_dictionary(data: bytes):
+    dictionary = zstandard.ZstdCompressionDict(data)
+    dictionary.precompute_compress(compression_params=_params())
+    return dictionary
+
+
+def _dictionary(dict_id):
+    dictionary = _dictionaries.get(dict_id)
+    if dictionary is None:
+        from .models import CompressionDictionary
+
+        dictionary = load_dictionary(CompressionDictionary.objects.get(pk=dict_id).get_data())
+        _dictionaries[dict_id] = dictionary
+    return dictionary
+
+
+def active_dictionary_id(room_id):
+    """Newest dictionary of the room, else the newest global one, else None."""
+    now = time.monotonic()
+    cached = _active.get(room_id)
+    if cached and cached[0] > now:
+        return cached[1]
+    from .models import CompressionDictionary
+
+    dict_id = (
+        CompressionDictionary.objects.filter(Q(room_id=room_id) | Q(room__isnull=True))
+        .order_by(F("room_id").asc(nulls_last=True), "-created_at")
+        .values_list("pk", flat=True)
+        .first()
+    )
+    _active[room_id] = (now + ACTIVE_DICTIONARY_TTL, dict_id)
+    return dict_id
+
+
+def new_compressor(dictionary=None):
+    if dictionary is None:
+        return zstandard.ZstdCompressor(compression_params=_params())
+    return zstandard.ZstdCompressor(dict_data=dictionary, compression_params=_params())
+
+
+def compress(plaintext: bytes, compressor, dict_id=None) -> bytes:
+    """Encoded body; dict_id is the id of the dictionary ``compressor`` uses, if any."""
+    if dict_id is None:
+        return bytes([FORMAT_ZSTD]) + compressor.compress(plaintext)
+    return (
+        bytes([FORMAT_ZSTD_DICT])
+        + dict_id.to_bytes(4, "big")
+        + compressor.compress(plaintext)
+    )
+
+
+def encode_body(plaintext: bytes, room_id=None) -> bytes:
+    """Compress a message body for storage, or return it unchanged if that doesn't help."""
+    if not available():
+        return plaintext
+    dict_id = active_dictionary_id(room_id)
+    compressors = _local.__dict__.setdefault("compressors", {})
+    compressor = compressors.get(dict_id)
+    if compressor is None:
+        dictionary = _dictionary(dict_id) if dict_id is not None else None
+        compressor = compressors[dict_id] = new_compressor(dictionary)
+    body = compress(plaintext, compressor, dict_id)
+    return body if len(body) < len(plaintext) else plaintext
+
+
+def new_decompressor(dictionary=None):
+    if dictionary is None:
+        return zstandard.ZstdDecompressor(format=zstandard.FORMAT_ZSTD1_MAGICLESS)
+    return zstandard.ZstdDecompressor(
+        dict_data=dictionary, format=zstandard.FORMAT_ZSTD1_MAGICLESS
+    )
+
+
+def decompress(body: bytes, decompressor) -> bytes:
+    """Inverse of compress()."""
+    if body[0] == FORMAT_ZSTD_DICT:
+        return decompressor.decompress(body[5:])
+    return decompressor.decompress(body[1:])
+
+
+def decode_body(body: bytes) -> bytes:
+    """Inverse of encode_body."""
+    if not body or body[0] < 0xF8:
+        return body
+    if body[0] not in (FORMAT_ZSTD, FORMAT_ZSTD_DICT):
+        raise ValueError(f"Unknown message body format {body[0]:#x}")
+    if zstandard is None:
+        raise RuntimeError("zstandard is required to read compressed messages")
+    dict_id = int.from_bytes(body[1:5], "big") if body[0] == FORMAT_ZSTD_DICT else None
+    decompressors = _local.__dict__.setdefault("decompressors", {})
+    decompressor = decompressors.get(dict_id)
+    if decompressor is None:
+        dictionary = _dictionary(dict_id) if dict_id is not None else None
+        decompressor = decompressors[dict_id] = new_decompressor(dictionary)
+    return decompress(body, decompressor)
+
+
+def train(samples, size):
+    """Train a dictionary (raw bytes) on sample message bodies."""
+    return zstandard.train_dictionary(size, samples).as_bytes()
@@ -1,13 +1,31 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from channels.db import database_sync_to_async
 #from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.tokens import UntypedToken
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
 from jwt import decode as jwt_decode
 from django.conf import settings
+from . import metrics, replay, typing_indicators
+from .events import room_group_name
+from .fanout import get_hub
+from .models import Membership
+from .ratelimit import ahit_leased, bucket, scope_client_ip
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
+
+# close code for the "disconnect" slow consumer policy; the client should
+# reconnect and send "resume"
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
 
 # Clients should pass JWT token as querystring ?token=...
 class RoomConsumer(AsyncJsonWebsocketConsumer):
@@ -15,9 +33,13 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         # simple JWT token from querystring
         query = self.scope["query_string"].decode()
         token = None
+        # clients that ack opt in to flow control with ?acks=1 (or their first ack)
+        self.acks = False
         for part in query.split("&"):
             if part.startswith("token="):
                 token = part.split("=", 1)[1]
+            elif part == "acks=1":
+                self.acks = True
         if not token:
             await self.close()
             return
@@ -37,24 +59,307 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         except Exception:
             await self.close()
             return
+        self.rooms = set()
+        # highest event_seq delivered per room, and live events held back
+        # while a room is being replayed
+        self.last_seq = {}
+        self.pending = {}
+        # typing: when we last reported per room, and the last list sent
+        self.typing_reported = {}
+        self.typing_sent = {}
+        # outgoing room frames go through a bounded queue drained by a writer
+        # task, so a slow client never blocks the fan-out to everyone else
+        self.outbox = deque()
+        self.outbox_ready = asyncio.Event()
+        self.dropped = 0
+        self.closing = False
+        # flow control: frames sent (each carries its number "n") and the
+        # highest "n" the client has acknowledged; only for clients that ack
+        self.sent = 0
+        self.acked = 0
         await self.accept()
+        self.writer = asyncio.create_task(self.drain_outbox())
         # now client sends subscribe messages for room ids
 
+    async def disconnect(self, code):
+        writer = getattr(self, "writer", None)
+        if writer is not None:
+            writer.cancel()
+            if self.dropped:
+                await metrics.aincr("ws_frames_dropped", self.dropped)
+        if settings.CHAT_FANOUT_HUB:
+            await get_hub().discard(self)
+        else:
+            for room_id in getattr(self, "rooms", ()):
+                await self.channel_layer.group_discard(
+                    room_group_name(room_id), self.channel_name
+                )
+
     async def receive_json(self, content):
         action = content.get("action")
+        if action == "ack":
+            # {"action": "ack", "n": <n of the last frame handled>}; not rate
+            # limited, acks are what keep the frames flowing
+            n = content.get("n")
+            if type(n) is int and self.acked < n <= self.sent:
+                self.acks = True
+                self.acked = n
+                self.outbox_ready.set()
+            return
+        if action == "typing":
+            # {"action": "typing", "room_id": "...", "typing": true|false};
+            # rate limited only past its own throttle (see report_typing)
+            await self.report_typing(str(content.get("room_id")), content.get("typing", True))
+            return
+        if await self.rate_limited(action):
+            return
         if action == "subscribe":
-            room_id = content.get("room_id")
-            await self.channel_layer.group_add(f"room_{room_id}", self.channel_name)
+            await self.join_room(str(content.get("room_id")))
         elif action == "unsubscribe":
-            room_id = content.get("room_id")
-            await self.channel_layer.group_discard(f"room_{room_id}", self.channel_name)
+            await self.leave_room(str(content.get("room_id")))
+        elif action == "resume":
+            # {"action": "resume", "rooms": {"<room_id>": <last event_seq>, ...}}
+            rooms = content.get("rooms")
+            if not isinstance(rooms, dict) or not all(
+                type(last_seq) is int and last_seq >= 0 for last_seq in rooms.values()
+            ):
+                await self.send_json(
+                    {
+                        "type": "error",
+                        "error": "invalid_request",
+                        "action": action,
+                        "detail": "rooms must map room ids to event_seq integers",
+                    }
+                )
+                return
+            for room_id, last_seq in rooms.items():
+                await self.resume_room(room_id, last_seq)
+
+    async def rate_limited(self, action) -> bool:
+        """Take a token from the connection's buckets; answer with an error if empty."""
+        retry_after = await ahit_leased(
+            bucket("ws_user", self.user.id), bucket("ws_ip", scope_client_ip(self.scope))
+        )
+        if retry_after:
+            await self.send_json(
+                {
+                    "type": "error",
+                    "error": "rate_limited",
+                    "action": action,
+                    "retry_after": math.ceil(retry_after),
+                }
+            )
+        return bool(retry_after)
+
+    async def report_typing(self, room_id, typing):
+        if room_id not in self.rooms:
+            return
+        now = time.monotonic()
+        if typing:
+            # refreshes inside the throttle window carry no new information,
+            # and don't use up the buckets subscribe and resume need
+            last = self.typing_reported.get(room_id)
+            if last is not None and now - last < settings.CHAT_TYPING_THROTTLE:
+                return
+        if await self.rate_limited("typing"):
+            return
+        if typing:
+            self.typing_reported[room_id] = now
+        else:
+            self.typing_reported.pop(room_id, None)
+        await typing_indicators.report(room_id, self.user.username, bool(typing))
+
+    async def resume_room(self, room_id, last_seq):
+        # subscribe first and hold live events back, so nothing published
+        # while we read the buffer is missed or delivered out of order
+        self.pending[room_id] = []
+        if not await self.join_room(room_id):
+            del self.pending[room_id]
+            return
+        events = await replay.read_since(room_id, last_seq)
+        if events is None:
+            await self.enqueue({"type": "resync_required", "room_id": room_id})
+            events = []
+        else:
+            self.last_seq[room_id] = last_seq
+        while True:
+            for event in events:
+                await self.dispatch({**event, "replayed": True})
+            events = self.pending[room_id]
+            if not events:
+                del self.pending[room_id]
+                break
+            self.pending[room_id] = []
+
+    async def send_room_event(self, event, payload):
+        """Send a room event frame, in event_seq order and without duplicates."""
+        room_id = event["room_id"]
+        pending = self.pending.get(room_id)
+        if pending is not None and not event.get("replayed"):
+            pending.append(event)
+            return
+        seq = event.get("event_seq")
+        if seq is not None:
+            if seq <= self.last_seq.get(room_id, 0):
+                return
+            self.last_seq[room_id] = seq
+            payload["event_seq"] = seq
+        await self.enqueue(payload)
+
+    async def enqueue(self, frame):
+        """Queue a frame for the client, applying CHAT_WS_SLOW_POLICY when the queue is full."""
+        if self.closing:
+            return
+        if len(self.outbox) >= settings.CHAT_WS_SEND_QUEUE:
+            policy = settings.CHAT_WS_SLOW_POLICY
+            if policy == "disconnect":
+                self.closing = True
+                self.outbox.clear()
+                await metrics.aincr("ws_slow_disconnects")
+                await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+                return
+            if policy == "coalesce":
+                before = len(self.outbox)
+                self.coalesce_outbox()
+                self.dropped += before - len(self.outbox)
+                await metrics.aincr("ws_outbox_coalesced")
+            if len(self.outbox) >= settings.CHAT_WS_SEND_QUEUE:
+                # drop_oldest (or coalescing could not make room); the client
+                # sees the event_seq gap and can "resume"
+                self.outbox.popleft()
+                self.dropped += 1
+        self.outbox.append(frame)
+        self.outbox_ready.set()
+
+    def coalesce_outbox(self):
+        """Collapse queued frames into one per room pointing at its latest seqs."""
+        merged = {}
+        for frame in self.outbox:
+            if frame["type"] == "typing":
+                continue
+            room_id = frame["room_id"]
+            summary = merged.setdefault(room_id, {"type": "room_changed", "room_id": room_id})
+            if frame["type"] == "resync_required":
+                summary["type"] = "resync_required"
+            for key in ("seq", "event_seq"):
+                if frame.get(key) is not None:
+                    summary[key] = max(summary.get(key, 0), frame[key])
+        self.outbox = deque(merged.values())
+
+    async def drain_outbox(self):
+        # The server's send() does not wait for the client (Daphne writes into
+        # the transport buffer), so backpressure comes from acks: at most
+        # CHAT_WS_ACK_WINDOW frames are unacknowledged, the rest wait here in
+        # the bounded outbox where CHAT_WS_SLOW_POLICY applies. Clients that
+        # never ack get no window, or they would stall after the first one.
+        while True:
+            await self.outbox_ready.wait()
+            self.outbox_ready.clear()
+            window = settings.CHAT_WS_ACK_WINDOW if self.acks else 0
+            while self.outbox and not (window and self.sent - self.acked >= window):
+                frame = self.outbox.popleft()
+                self.sent += 1
+                frame["n"] = self.sent
+                await self.send_json(frame)
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                await metrics.aincr("ws_frames_dropped", dropped)
+
+    @database_sync_to_async
+    def is_member(self, room_id):
+        try:
+            return Membership.objects.filter(room_id=room_id, user_id=self.user.id).exists()
+        except (ValueError, ValidationError):
+            return False
+
+    async def join_room(self, room_id):
+        """Subscribe to a room's events; members only. Returns whether it did."""
+        if not await self.is_member(room_id):
+            await self.send_json(
+                {"type": "error", "error": "not_a_member", "room_id": room_id}
+            )
+            return False
+        # with the fan-out hub the node holds one subscription per room and
+        # dispatches to us in memory; otherwise join the channel layer group
+        if settings.CHAT_FANOUT_HUB:
+            try:
+                await get_hub().subscribe(room_id, self)
+            except Exception:
+                logger.warning("Could not subscribe to room %s", room_id, exc_info=True)
+                await self.send_json(
+                    {"type": "error", "error": "unavailable", "room_id": room_id}
+                )
+                return False
+        else:
+            await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+        self.rooms.add(room_id)
+        return True
+
+    async def leave_room(self, room_id):
+        if settings.CHAT_FANOUT_HUB:
+            await get_hub().unsubscribe(room_id, self)
+        else:
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+        self.rooms.discard(room_id)
+        self.last_seq.pop(room_id, None)
+        self.typing_reported.pop(room_id, None)
+        self.typing_sent.pop(room_id, None)
 
     async def new_message(self, event):
         # forward minimal payload
-        await self.send_json(
+        await self.send_room_event(
+            event,
             {
                 "type": "new_message",
                 "room_id": event["room_id"],
                 "message_id": event["message_id"],
-            }
+                "seq": event.get("seq"),
+            },
+        )
+
+    async def new_messages(self, event):
+        # a coalesced burst (CHAT_NEW_MESSAGE_WINDOW_MS): one frame for all of it
+        await self.send_room_event(
+            event,
+            {
+                "type": "new_messages",
+                "room_id": event["room_id"],
+                "messages": event["messages"],
+                "seq": event["seq"],
+            },
+        )
+
+    async def message_changed(self, event):
+        # edit or delete; clients fetch rooms/<id>/changes/?since=<their seq>
+        await self.send_room_event(
+            event,
+            {
+                "type": "message_changed",
+                "room_id": event["room_id"],
+                "message_id": event["message_id"],
+                "seq": event["seq"],
+                "deleted": event["deleted"],
+            },
+        )
+
+    async def members_changed(self, event):
+        if self.user.id in event["removed"]:
+            await self.leave_room(event["room_id"])
+        await self.send_room_event(
+            event,
+            {
+                "type": "members_changed",
+                "room_id": event["room_id"],
+                "added": event["added"],
+                "removed": event["removed"],
+            },
+        )
+
+    async def typing_update(self, event):
+        room_id = event["room_id"]
+        if room_id not in self.rooms or self.typing_sent.get(room_id) == event["usernames"]:
+            return
+        self.typing_sent[room_id] = event["usernames"]
+        await self.enqueue(
+            {"type": "typing", "room_id": room_id, "usernames": event["usernames"]}
         )
@@ -0,0 +1,208 @@
+"""
+Read/write database routing with read replicas (DATABASE_REPLICAS).
+
+Writes always go to ``default``, and so do reads, except inside
+``replica_reads``: the read-only views are decorated with
+``@reads_from_replica`` and their queries go to a random healthy replica.
+
+- Read-your-writes: every write request marks its user in Valkey for
+  REPLICA_STICKY_SECONDS (StickyWritesMiddleware). While marked, the user
+  reads from the primary, so they always see what they just posted.
+- Lag: the primary rewrites a ReplicaHeartbeat row at most every
+  REPLICA_LAG_CHECK seconds, and a replica whose copy of it is more than
+  REPLICA_MAX_LAG behind is skipped until it catches up. When no replica is
+  healthy, reads fall back to the primary. A negative REPLICA_MAX_LAG turns
+  the check off, e.g. for a static copy that never receives the heartbeat.
+"""
+import contextvars
+import functools
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils.functional import SimpleLazyObject
+
+from . import metrics
+from .valkey import get_async_valkey, get_valkey
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+_replica = contextvars.ContextVar("chatapi_read_replica", default=None)
+
+_health_lock = threading.Lock()
+_healthy = []
+_checked_at = float("-inf")
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        # also for related lookups on objects loaded from a replica earlier
+        return _replica.get() or "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # every alias holds the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get their schema through replication (or the copy)
+        return db == "default"
+
+
+def sticky_key(user_id) -> str:
+    return f"djchat:{{user:{user_id}}}:wrote"
+
+
+def mark_write(user_id):
+    try:
+        get_valkey().set(sticky_key(user_id), 1, ex=settings.REPLICA_STICKY_SECONDS)
+    except Exception:
+        logger.warning("Could not mark user %s as a writer", user_id, exc_info=True)
+
+
+async def amark_write(user_id):
+    try:
+        await get_async_valkey().set(
+            sticky_key(user_id), 1, ex=settings.REPLICA_STICKY_SECONDS
+        )
+    except Exception:
+        logger.warning("Could not mark user %s as a writer", user_id, exc_info=True)
+
+
+def is_sticky(user_id) -> bool:
+    try:
+        return bool(get_valkey().exists(sticky_key(user_id)))
+    except Exception:
+        # can't tell: the primary is always correct
+        logger.warning("Could not check writes of user %s", user_id, exc_info=True)
+        return True
+
+
+def replica_lag(alias, primary_beat):
+    """
+    Seconds the replica is behind, at heartbeat granularity; None if it
+    can't be read.
+    """
+    from .models import ReplicaHeartbeat
+
+    try:
+        replica_beat = ReplicaHeartbeat.read(alias)
+    except DatabaseError:
+        logger.warning("Replica %s is not readable", alias, exc_info=True)
+        return None
+    if primary_beat is None:
+        return 0.0
+    if replica_beat is None:
+        return None
+    return max((primary_beat - replica_beat).total_seconds(), 0.0)
+
+
+def healthy_replicas() -> list:
+    """Replicas within REPLICA_MAX_LAG, re-checked every REPLICA_LAG_CHECK seconds."""
+    global _healthy, _checked_at
+    from .models import ReplicaHeartbeat
+
+    if settings.REPLICA_MAX_LAG < 0:
+        return settings.DATABASE_REPLICAS
+    if time.monotonic() - _checked_at < settings.REPLICA_LAG_CHECK:
+        return _healthy
+    with _health_lock:
+        if time.monotonic() - _checked_at < settings.REPLICA_LAG_CHECK:
+            return _healthy
+        try:
+            # the previous beat: a replica that has it is fully caught up
+            primary_beat = ReplicaHeartbeat.read("default")
+            ReplicaHeartbeat.write()
+        except DatabaseError:
+            logger.warning("Could not write the replica heartbeat", exc_info=True)
+            primary_beat = None
+        healthy = []
+        for alias in settings.DATABASE_REPLICAS:
+            lag = replica_lag(alias, primary_beat)
+            if lag is not None and lag <= settings.REPLICA_MAX_LAG:
+                healthy.append(alias)
+            else:
+                metrics.incr("replica_lagging")
+                logger.info("Replica %s lags (%s s), reading from the primary", alias, lag)
+        _healthy, _checked_at = healthy, time.monotonic()
+    return _healthy
+
+
+def choose_replica(user_id=None):
+    """The alias to read from, or None for the primary."""
+    if not settings.DATABASE_REPLICAS:
+        return None
+    if user_id is not None and is_sticky(user_id):
+        return None
+    healthy = healthy_replicas()
+    return random.choice(healthy) if healthy else None
+
+
+@contextmanager
+def replica_reads(user_id=None):
+    token = _replica.set(choose_replica(user_id))
+    try:
+        yield _replica.get()
+    finally:
+        _replica.reset(token)
+
+
+def reads_from_replica(view_method):
+    """Run a read-only APIView method's queries on a replica (see module doc)."""
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        with replica_reads(request.user.id):
+            return view_method(self, request, *args, **kwargs)
+
+    return wrapper
+
+
+class StickyWritesMiddleware:
+    """
+    Marks users who just made a successful write request. DRF authenticates
+    inside the view, so request.user is only known after the response.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        user_id = self.writer(request, response)
+        if user_id is not None:
+            mark_write(user_id)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        user_id = self.writer(request, response)
+        if user_id is not None:
+            await amark_write(user_id)
+        return response
+
+    def writer(self, request, response):
+        if request.method in SAFE_METHODS or response.status_code >= 400:
+            return None
+        user = getattr(request, "user", None)
+        # only a user DRF authenticated; the lazy session user may need a query
+        if user is None or isinstance(user, SimpleLazyObject) or not user.is_authenticated:
+            return None
+        return user.id
@@ -0,0 +1,84 @@
+"""
+Paginated room member directory (GET rooms/<id>/members/), cached in Valkey.
+
+Members are ordered by username and paged with a keyset cursor (the last
+username of the previous page), optionally filtered by a username prefix.
+Pages are cached under the room's directory version. Every membership change
+bumps the version once its transaction commits (Room.members_changed), so a
+cached page is never served after a change; old pages just expire.
+"""
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .valkey import get_valkey
+
+logger = logging.getLogger(__name__)
+
+MAX_LIMIT = 200
+
+
+def version_key(room_id) -> str:
+    return f"djchat:{{room:{room_id}}}:members:ver"
+
+
+def page_key(room_id, version, prefix, cursor, limit) -> str:
+    params = hashlib.sha1(json.dumps([prefix, cursor, limit]).encode()).hexdigest()
+    return f"djchat:{{room:{room_id}}}:members:{version}:{params}"
+
+
+def bump_version(room_id):
+    try:
+        get_valkey().incr(version_key(room_id))
+    except Exception:
+        # pages outlive the change by at most MEMBER_DIRECTORY_TTL
+        logger.warning("Could not bump member directory of room %s", room_id, exc_info=True)
+
+
+def load_page(room, prefix="", cursor="", limit=50) -> dict:
+    members = room.memberships.order_by("user__username")
+    if prefix:
+        members = members.filter(user__username__istartswith=prefix)
+    if cursor:
+        members = members.filter(user__username__gt=cursor)
+    rows = list(
+        members.values_list("user_id", "user__username", "user__email", "joined_at")[
+            : limit + 1
+        ]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "next_cursor": rows[-1][1] if has_more else None,
+        "results": [
+            {"id": user_id, "username": username, "email": email, "joined_at": joined_at}
+            for user_id, username, email, joined_at in rows
+        ],
+    }
+
+
+def member_page(room, prefix="", cursor="", limit=50) -> dict:
+    """One directory page, from the cache when the room hasn't changed since."""
+    client = get_valkey()
+    try:
+        # read the version first: a page stored under it is at least this fresh
+        version = client.get(version_key(room.pk)) or 0
+        key = page_key(room.pk, version, prefix, cursor, limit)
+        cached = client.get(key)
+    except Exception:
+        logger.warning("Member directory cache unavailable", exc_info=True)
+        return load_page(room, prefix, cursor, limit)
+    if cached is not None:
+        return json.loads(cached)
+
+    page = load_page(room, prefix, cursor, limit)
+    data = json.dumps(page, cls=DjangoJSONEncoder)
+    try:
+        client.set(key, data, ex=settings.MEMBER_DIRECTORY_TTL)
+    except Exception:
+        logger.warning("Could not cache member directory page", exc_info=True)
+    # same shape as a cached page
+    return json.loads(data)
@@ -0,0 +1,236 @@
+"""
+Room event publishing.
+
+Views and serializers publish through ``publish_room_event`` instead of calling
+``group_send`` themselves, so the delivery path lives in one place. Every event
+is stamped with the room's next ``event_seq`` and kept in the replay buffer
+(see replay.py) before it is delivered.
+
+With CHAT_NEW_MESSAGE_WINDOW_MS set, new messages in a busy room are
+coalesced: the first one is published right away and opens the room's window;
+messages posted while it is open are queued in Valkey and published together
+as one ``new.messages`` event when it ends. A window with nothing queued
+closes, so a quiet room never waits.
+
+The window key holds the time its batch is due. If the process that opened
+it dies, the next publisher to find the window a whole window overdue takes
+it over and flushes the batch; the batch outlives the window key, so a
+window that expired meanwhile hands it to the publisher that opens the next.
+"""
+import heapq
+import json
+import logging
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import fanout, metrics, replay
+from .valkey import get_async_valkey, get_valkey
+
+logger = logging.getLogger(__name__)
+
+# KEYS: window, batch. ARGV: message json, window (ms), window key ttl (ms).
+# Opens the room's window (1: publish the message now) or queues the message
+# for the window's batch (0), atomically with respect to BATCH_TAKE_SCRIPT.
+# 2: the message is queued and the batch is this caller's to flush now, as it
+# was left behind by an expired window or its window is a whole window overdue.
+BATCH_ADD_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local window = tonumber(ARGV[2])
+local due = redis.call('GET', KEYS[1])
+if not due and redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('SET', KEYS[1], string.format('%d', now + window), 'PX', ARGV[3])
+    return 1
+end
+redis.call('RPUSH', KEYS[2], ARGV[1])
+redis.call('PEXPIRE', KEYS[2], string.format('%d', tonumber(ARGV[3]) * 2))
+if not due or now > tonumber(due) + window then
+    redis.call('SET', KEYS[1], string.format('%d', now + window), 'PX', ARGV[3])
+    return 2
+end
+return 0
+"""
+
+# KEYS: window, batch. ARGV: window (ms), window key ttl (ms).
+# Takes the queued messages and keeps the window open, or closes it if none.
+BATCH_TAKE_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+if #items == 0 then
+    redis.call('DEL', KEYS[1])
+else
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+    redis.call('DEL', KEYS[2])
+    redis.call('SET', KEYS[1], string.format('%d', now + tonumber(ARGV[1])), 'PX', ARGV[2])
+end
+return items
+"""
+
+
+def room_group_name(room_id) -> str:
+    return f"room_{room_id}"
+
+
+def publish_room_event(room_id, event: dict) -> None:
+    if settings.CHAT_FANOUT_HUB:
+        # stamped, buffered and published to every node in one round trip
+        replay.record(room_id, event, channel=fanout.room_channel(room_id))
+        return
+    event = replay.record(room_id, event)
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        print("Warning: No channel layer configured; skipping message notification.")
+        return
+    async_to_sync(channel_layer.group_send)(room_group_name(room_id), event)
+
+
+async def apublish_ephemeral_event(room_id, event: dict) -> None:
+    """Deliver a transient event (e.g. typing) without stamping or buffering it."""
+    if settings.CHAT_FANOUT_HUB:
+        await get_async_valkey().publish(fanout.room_channel(room_id), json.dumps(event))
+        return
+    channel_layer = get_channel_layer()
+    if channel_layer is not None:
+        await channel_layer.group_send(room_group_name(room_id), event)
+
+
+def window_key(room_id) -> str:
+    return f"djchat:{{room:{room_id}}}:newmsg:window"
+
+
+def batch_key(room_id) -> str:
+    return f"djchat:{{room:{room_id}}}:newmsg:batch"
+
+
+def _window_ttl_ms() -> int:
+    # outlives the window, so a window whose process died still closes soon;
+    # its batch is kept twice as long for the next publisher to take over
+    return settings.CHAT_NEW_MESSAGE_WINDOW_MS * 4 + 1000
+
+
+_scripts = {}
+
+
+def _script(source):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = get_valkey().register_script(source)
+    return script
+
+
+def publish_new_message(room, msg) -> None:
+    event = {
+        "type": "new.message",
+        "room_id": str(room.id),
+        "message_id": str(msg.id),
+        "seq": msg.seq,
+    }
+    if settings.CHAT_NEW_MESSAGE_WINDOW_MS:
+        item = json.dumps({"message_id": event["message_id"], "seq": msg.seq})
+        try:
+            opened = _script(BATCH_ADD_SCRIPT)(
+                [window_key(room.id), batch_key(room.id)],
+                [item, settings.CHAT_NEW_MESSAGE_WINDOW_MS, _window_ttl_ms()],
+            )
+        except Exception:
+            logger.warning("Could not coalesce new message events", exc_info=True)
+        else:
+            if opened == 2:
+                # an orphaned batch, now with this message in it
+                _flusher.schedule(room.id, 0)
+            if opened != 1:
+                return
+            _flusher.schedule(room.id, settings.CHAT_NEW_MESSAGE_WINDOW_MS / 1000)
+    publish_room_event(room.id, event)
+
+
+def flush_new_messages(room_id) -> int:
+    """
+    End a coalescing window: publish the messages queued during it as one
+    ``new.messages`` event and keep the window open for another round, or
+    close it if there were none. Returns the number of messages published.
+    """
+    items = _script(BATCH_TAKE_SCRIPT)(
+        [window_key(room_id), batch_key(room_id)],
+        [settings.CHAT_NEW_MESSAGE_WINDOW_MS, _window_ttl_ms()],
+    )
+    if not items:
+        return 0
+    messages = [json.loads(item) for item in items]
+    publish_room_event(
+        room_id,
+        {
+            "type": "new.messages",
+            "room_id": str(room_id),
+            "messages": messages,
+            "seq": max(m["seq"] for m in messages),
+        },
+    )
+    metrics.incr("new_message_events_saved", len(messages) - 1)
+    _flusher.schedule(room_id, settings.CHAT_NEW_MESSAGE_WINDOW_MS / 1000)
+    return len(messages)
+
+
+class _WindowFlusher:
+    """One thread per process ending the coalescing windows this process opened or took over."""
+
+    def __init__(self):
+        self._due = []  # heap of (monotonic deadline, room_id)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def schedule(self, room_id, delay):
+        with self._cond:
+            heapq.heappush(self._due, (time.monotonic() + delay, str(room_id)))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="chatapi-window-flusher", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    timeout = self._due[0][0] - time.monotonic() if self._due else None
+                    self._cond.wait(timeout)
+                _, room_id = heapq.heappop(self._due)
+            try:
+                flush_new_messages(room_id)
+            except Exception:
+                # the room's next publisher takes the window over once it's overdue
+                logger.exception("Could not flush new messages of room %s", room_id)
+
+
+_flusher = _WindowFlusher()
+
+
+def publish_message_changed(room, msg) -> None:
+    publish_room_event(
+        room.id,
+        {
+            "type": "message.changed",
+            "room_id": str(room.id),
+            "message_id": str(msg.id),
+            "seq": msg.seq,
+            "deleted": msg.deleted_at is not None,
+        },
+    )
+
+
+def publish_members_changed(room, added_ids=(), removed_ids=()) -> None:
+    # consumers of removed users drop their subscription when they see this
+    publish_room_event(
+        room.id,
+        {
+            "type": "members.changed",
+            "room_id": str(room.id),
+            "added": list(added_ids),
+            "removed": list(removed_ids),
+        },
+    )
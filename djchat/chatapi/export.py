@@ -0,0 +1,184 @@
+"""
+Streaming room history export, as NDJSON or as a zip with the attachments.
+
+Everything is a generator pipeline over a server-side cursor
+(``iterator(chunk_size=...)``): messages are decrypted and written out one
+chunk at a time, so memory stays flat whatever the size of the room. Used by
+RoomExportView and `manage.py export_room`.
+"""
+import mimetypes
+import queue
+import threading
+import zipfile
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+
+from .models import FileAttachment, Message
+from .serializers import Base64Field
+
+CHUNK_SIZE = 500
+FILE_CHUNK = 64 * 1024
+
+
+def attachment_path(att) -> str:
+    """Name of an attachment inside the zip export."""
+    extension = mimetypes.guess_extension(att.content_type) or ".bin"
+    return f"attachments/{att.id}{extension}"
+
+
+def message_record(room, m) -> dict:
+    record = {
+        "id": str(m.id),
+        "seq": m.seq,
+        "sender": m.sender.username if m.sender else None,
+        "created_at": m.created_at,
+        "edited_at": m.edited_at,
+    }
+    if room.e2e:
+        b64 = Base64Field()
+        record["ciphertext"] = b64.to_representation(m.ciphertext)
+        record["nonce"] = b64.to_representation(m.nonce)
+        record["key_version"] = m.key_version
+    else:
+        record["plaintext"] = m.decrypt(room).decode()
+    attachments = list(m.attachments.all())
+    if attachments:
+        record["attachments"] = [
+            {
+                "id": str(att.id),
+                "path": attachment_path(att),
+                "file_size": att.file_size,
+                "content_type": att.content_type,
+            }
+            for att in attachments
+        ]
+    return record
+
+
+def iter_messages(room, chunk_size=CHUNK_SIZE):
+    return (
+        Message.objects.filter(room=room, deleted_at__isnull=True)
+        .select_related("sender")
+        .prefetch_related("attachments")
+        .order_by("created_at")
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def ndjson_lines(room, chunk_size=CHUNK_SIZE):
+    """One JSON object per message, oldest first."""
+    encoder = DjangoJSONEncoder()
+    for m in iter_messages(room, chunk_size):
+        yield (encoder.encode(message_record(room, m)) + "\n").encode()
+
+
+def ndjson_chunks(room, chunk_size=CHUNK_SIZE):
+    """ndjson_lines batched into writes of about FILE_CHUNK bytes."""
+    batch, size = [], 0
+    for line in ndjson_lines(room, chunk_size):
+        batch.append(line)
+        size += len(line)
+        if size >= FILE_CHUNK:
+            yield b"".join(batch)
+            batch, size = [], 0
+    if batch:
+        yield b"".join(batch)
+
+
+class _Chunks:
+    """Write-only, unseekable file object: zipfile writes into it, we drain it."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def zip_chunks(room, chunk_size=CHUNK_SIZE):
+    """A zip with messages.ndjson and the attachment files, produced as it is read."""
+    # the deflate stream buffers internally, so many writes produce nothing yet
+    return (chunk for chunk in _zip_chunks(room, chunk_size) if chunk)
+
+
+def _zip_chunks(room, chunk_size):
+    out = _Chunks()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        with zf.open("messages.ndjson", "w", force_zip64=True) as entry:
+            for chunk in ndjson_chunks(room, chunk_size):
+                entry.write(chunk)
+                yield out.take()
+        attachments = (
+            FileAttachment.objects.filter(
+                message__room=room, message__deleted_at__isnull=True
+            )
+            .order_by("uploaded_at")
+            .iterator(chunk_size=chunk_size)
+        )
+        for att in attachments:
+            # files are already compressed more often than not
+            info = zipfile.ZipInfo(attachment_path(att))
+            info.compress_type = zipfile.ZIP_STORED
+            with att.file.open("rb") as f, zf.open(info, "w", force_zip64=True) as entry:
+                while data := f.read(FILE_CHUNK):
+                    entry.write(data)
+                    yield out.take()
+    yield out.take()
+
+
+async def aiter_in_thread(iterator, max_pending=8):
+    """
+    Run a blocking iterator (with DB access) in its own thread and yield its
+    items asynchronously, for StreamingHttpResponse under ASGI, which would
+    otherwise read a sync iterator to the end before sending anything. The
+    bounded queue keeps memory constant; closing the response stops the thread.
+    """
+    items = queue.Queue(max_pending)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(done)
+        except Exception as e:
+            put(e)
+        finally:
+            # release the cursor and open files, then this thread's DB connection
+            if hasattr(iterator, "close"):
+                iterator.close()
+            connections.close_all()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = await sync_to_async(items.get, thread_sensitive=False)()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,178 @@
+"""
+Node-local fan-out hub.
+
+Every ASGI process keeps a single Valkey pub/sub subscription per active room
+and hands published events to its local RoomConsumer instances in memory.
+Publishing a room event (events.publish_room_event) therefore costs one PUBLISH,
+delivered once per node, instead of one channel layer message per connected socket.
+"""
+import asyncio
+import json
+import logging
+import weakref
+
+from .valkey import new_async_valkey
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = "djchat:room:"
+# seconds to wait for Valkey to confirm a new room subscription
+SUBSCRIBE_TIMEOUT = 5.0
+
+
+def room_channel(room_id) -> str:
+    return f"{CHANNEL_PREFIX}{room_id}"
+
+
+class FanoutHub:
+    def __init__(self):
+        self._rooms: dict[str, set] = {}
+        # rooms whose SUBSCRIBE Valkey has not confirmed yet, and how many
+        # SUBSCRIBEs per room are in flight (after a quick unsubscribe and
+        # subscribe, the first confirmation is not the one to wait for)
+        self._confirmed: dict[str, asyncio.Future] = {}
+        self._in_flight: dict[str, int] = {}
+        self._lock = asyncio.Lock()
+        self._valkey = None
+        self._pubsub = None
+        self._reader = None
+
+    def local_listeners(self, room_id) -> int:
+        return len(self._rooms.get(str(room_id), ()))
+
+    async def subscribe(self, room_id, consumer) -> None:
+        """
+        Add a local listener. Returns once Valkey has confirmed the room's
+        subscription, so every event published from then on is delivered
+        (a resume can read the replay buffer right after). Raises if the
+        SUBSCRIBE fails; the consumer is then not added.
+        """
+        room_id = str(room_id)
+        async with self._lock:
+            listeners = self._rooms.get(room_id)
+            if listeners is None:
+                # first local listener: open the node's subscription for the room
+                listeners = self._rooms[room_id] = set()
+                if self._pubsub is None:
+                    self._valkey = new_async_valkey()
+                    self._pubsub = self._valkey.pubsub()
+                self._confirmed[room_id] = asyncio.get_running_loop().create_future()
+                self._in_flight[room_id] = self._in_flight.get(room_id, 0) + 1
+                try:
+                    await self._pubsub.subscribe(room_channel(room_id))
+                except Exception:
+                    # not subscribed after all: the next listener tries again
+                    del self._rooms[room_id]
+                    in_flight = self._in_flight.pop(room_id, 1) - 1
+                    if in_flight > 0:
+                        self._in_flight[room_id] = in_flight
+                    self._set_confirmed(room_id)
+                    raise
+                if self._reader is None or self._reader.done():
+                    self._reader = asyncio.create_task(self._read())
+            listeners.add(consumer)
+            confirmed = self._confirmed.get(room_id)
+        # outside the lock: the reader may need it to finish a dispatch first
+        if confirmed is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(confirmed), SUBSCRIBE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Valkey did not confirm the subscription to room %s", room_id)
+
+    async def unsubscribe(self, room_id, consumer) -> None:
+        room_id = str(room_id)
+        async with self._lock:
+            listeners = self._rooms.get(room_id)
+            if listeners is None:
+                return
+            listeners.discard(consumer)
+            if not listeners:
+                del self._rooms[room_id]
+                self._set_confirmed(room_id)
+                await self._pubsub.unsubscribe(room_channel(room_id))
+                if not self._rooms:
+                    if asyncio.current_task() is self._reader:
+                        # during a dispatch (e.g. members.changed removing the
+                        # last listener) the reader must not cancel itself
+                        asyncio.create_task(self._stop_if_idle())
+                    else:
+                        await self._stop()
+
+    async def discard(self, consumer) -> None:
+        """Drop a consumer from every room it listens to (on disconnect)."""
+        for room_id in [r for r, listeners in self._rooms.items() if consumer in listeners]:
+            await self.unsubscribe(room_id, consumer)
+
+    async def _stop_if_idle(self):
+        async with self._lock:
+            if not self._rooms:
+                await self._stop()
+
+    def _set_confirmed(self, room_id):
+        confirmed = self._confirmed.pop(room_id, None)
+        if confirmed is not None and not confirmed.done():
+            confirmed.set_result(None)
+
+    async def _stop(self):
+        for room_id in list(self._confirmed):
+            self._set_confirmed(room_id)
+        self._in_flight.clear()
+        if self._reader is not None:
+            reader, self._reader = self._reader, None
+            reader.cancel()
+            # let it unwind before its connection is closed under it
+            await asyncio.gather(reader, return_exceptions=True)
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            await self._valkey.aclose()
+            self._pubsub = None
+            self._valkey = None
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Fan-out hub lost its Valkey subscription")
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            room_id = message["channel"].removeprefix(CHANNEL_PREFIX)
+            if message["type"] == "subscribe":
+                in_flight = self._in_flight.pop(room_id, 1) - 1
+                if in_flight > 0:
+                    self._in_flight[room_id] = in_flight
+                else:
+                    self._set_confirmed(room_id)
+                continue
+            if message["type"] != "message":
+                continue
+            try:
+                event = json.loads(message["data"])
+            except ValueError:
+                logger.warning("Dropping malformed fan-out event for room %s", room_id)
+                continue
+            await self.dispatch(room_id, event)
+
+    async def dispatch(self, room_id, event: dict) -> None:
+        """Deliver an event to every local consumer subscribed to the room."""
+        for consumer in list(self._rooms.get(str(room_id), ())):
+            try:
+                await consumer.dispatch(event)
+            except Exception:
+                logger.exception("Fan-out delivery to %s failed", consumer.channel_name)
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_hub() -> FanoutHub:
+    """Return the hub for the running event loop (one per ASGI process)."""
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = FanoutHub()
+    return hub
@@ -0,0 +1,105 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatapi import compression
+from chatapi.crypto import decrypt_with_room_key, encrypt_with_room_key
+from chatapi.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure storage saved and CPU added by compress-then-encrypt on a chat "
+        "corpus: a text file with one message per line, or recent messages from "
+        "the database. A dictionary is trained on the first half and the "
+        "modes are compared on the second half."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--corpus", help="UTF-8 text file, one message per line")
+        parser.add_argument(
+            "--limit", type=int, default=20000,
+            help="Number of messages to use (from the corpus or the database)",
+        )
+        parser.add_argument("--size", type=int, default=16384, help="Dictionary size in bytes")
+
+    def handle(self, *args, **options):
+        if compression.zstandard is None:
+            raise CommandError("zstandard is not installed")
+        corpus = self.load(options)
+        if len(corpus) < 200:
+            raise CommandError(f"Need at least 200 messages, got {len(corpus)}")
+        half = len(corpus) // 2
+        train, test = corpus[:half], corpus[half:]
+        dictionary = compression.load_dictionary(compression.train(train, options["size"]))
+
+        modes = [
+            ("raw", lambda pt: pt, lambda body: body),
+            (
+                "zstd",
+                self.encoder(compression.new_compressor()),
+                self.decoder(compression.new_decompressor()),
+            ),
+            (
+                "zstd+dict",
+                self.encoder(compression.new_compressor(dictionary), 1),
+                self.decoder(compression.new_decompressor(dictionary)),
+            ),
+        ]
+        key = os.urandom(32)
+        raw_size = sum(len(m) for m in test)
+        self.stdout.write(
+            f"{len(test)} messages, {raw_size} bytes of text "
+            f"(avg {raw_size / len(test):.0f}), dictionary {options['size']} bytes"
+        )
+        header = ("mode", "stored", "vs raw", "write us/msg", "read us/msg")
+        self.stdout.write("{:<10} {:>10} {:>7} {:>13} {:>12}".format(*header))
+        baseline = None
+        for name, encode, decode in modes:
+            started = time.perf_counter()
+            rows = [encrypt_with_room_key(key, encode(pt)) for pt in test]
+            write_time = time.perf_counter() - started
+            started = time.perf_counter()
+            for ct, nonce in rows:
+                decode(decrypt_with_room_key(key, ct, nonce))
+            read_time = time.perf_counter() - started
+            stored = sum(len(ct) + len(nonce) for ct, nonce in rows)
+            baseline = baseline or stored
+            self.stdout.write(
+                f"{name:<10} {stored:>10} {stored / baseline:>7.1%} "
+                f"{write_time / len(test) * 1e6:>13.1f} {read_time / len(test) * 1e6:>12.1f}"
+            )
+
+    def encoder(self, compressor, dict_id=None):
+        def encode(pt):
+            body = compression.compress(pt, compressor, dict_id)
+            # same rule as encode_body: keep whichever is smaller
+            return body if len(body) < len(pt) else pt
+
+        return encode
+
+    def decoder(self, decompressor):
+        def decode(body):
+            if body[0] < 0xF8:
+                return body
+            return compression.decompress(body, decompressor)
+
+        return decode
+
+    def load(self, options):
+        if options["corpus"]:
+            with open(options["corpus"], encoding="utf-8") as f:
+                lines = (line.rstrip("\n") for line in f)
+                return [line.encode() for line in lines if line][: options["limit"]]
+        rooms = {}
+        recent = (
+            Message.objects.filter(deleted_at__isnull=True, room__e2e=False)
+            .select_related("room")
+            .order_by("-created_at")[: options["limit"]]
+        )
+        corpus = [
+            m.decrypt(rooms.setdefault(m.room_id, m.room))
+            for m in recent.iterator(chunk_size=500)
+        ]
+        return corpus[::-1]
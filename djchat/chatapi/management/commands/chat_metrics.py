@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from chatapi import metrics
+
+
+class Command(BaseCommand):
+    help = "Show the shared chat counters (dropped WebSocket frames, slow consumers, ...)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Reset all counters")
+
+    def handle(self, *args, **options):
+        for name, value in sorted(metrics.snapshot().items()):
+            self.stdout.write(f"{name} {value}")
+        if options["reset"]:
+            metrics.reset()
@@ -0,0 +1,40 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatapi import export
+from chatapi.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Export a room's full history, decrypted, as NDJSON or as a zip with the "
+        "attachments. Streams from a server-side cursor, so memory use does not "
+        "depend on the size of the room."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("room_id")
+        parser.add_argument("--format", choices=["ndjson", "zip"], default="ndjson")
+        parser.add_argument("-o", "--output", help="Output file (default: stdout)")
+        parser.add_argument("--chunk-size", type=int, default=export.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            room = Room.objects.get(id=options["room_id"])
+        except (Room.DoesNotExist, ValueError):
+            raise CommandError(f"Room {options['room_id']} not found")
+        if options["format"] == "zip":
+            chunks = export.zip_chunks(room, options["chunk_size"])
+        else:
+            chunks = export.ndjson_chunks(room, options["chunk_size"])
+
+        out = open(options["output"], "wb") if options["output"] else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if options["output"]:
+                out.close()
+            else:
+                out.flush()
@@ -0,0 +1,124 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from chatapi.models import AttachmentBlob, FileAttachment
+
+
+class Command(BaseCommand):
+    help = (
+        "Garbage-collect the content-addressed attachment store: delete blobs no "
+        "attachment refers to anymore, in small batches each in its own short "
+        "transaction."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--pause", type=float, default=0.05,
+            help="Seconds to sleep between batches",
+        )
+        parser.add_argument(
+            "--recount", action="store_true",
+            help="First recompute every blob's ref_count from its attachments",
+        )
+        parser.add_argument(
+            "--sweep-files", action="store_true",
+            help="Also remove files under chat_blobs/ no blob refers to",
+        )
+
+    def handle(self, *args, **options):
+        if options["recount"]:
+            fixed = self.recount(options)
+            self.stdout.write(f"Recounted blob references, fixed {fixed}")
+        removed = self.collect(options)
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} unreferenced blobs"))
+        if options["sweep_files"]:
+            removed = self.sweep_files(options["batch_size"])
+            self.stdout.write(self.style.SUCCESS(f"Removed {removed} orphaned files"))
+
+    def recount(self, options):
+        refs = (
+            FileAttachment.objects.filter(blob=OuterRef("pk"))
+            .order_by()
+            .values("blob")
+            .annotate(n=Count("pk"))
+            .values("n")
+        )
+        ids = list(AttachmentBlob.objects.order_by("pk").values_list("pk", flat=True))
+        fixed = 0
+        for start in range(0, len(ids), options["batch_size"]):
+            batch = ids[start : start + options["batch_size"]]
+            with transaction.atomic():
+                wrong = (
+                    AttachmentBlob.objects.select_for_update()
+                    .filter(pk__in=batch)
+                    .annotate(actual=Coalesce(Subquery(refs), 0))
+                    .exclude(ref_count=Coalesce(Subquery(refs), 0))
+                )
+                for blob in wrong:
+                    AttachmentBlob.objects.filter(pk=blob.pk).update(ref_count=blob.actual)
+                    fixed += 1
+            time.sleep(options["pause"])
+        return fixed
+
+    def collect(self, options):
+        storage = AttachmentBlob._meta.get_field("file").storage
+        removed = 0
+        while True:
+            with transaction.atomic():
+                # locked rows are being re-shared by an upload right now
+                blobs = list(
+                    AttachmentBlob.objects.select_for_update(skip_locked=True, of=("self",))
+                    .filter(ref_count=0, attachments__isnull=True)
+                    .values_list("pk", "file")[: options["batch_size"]]
+                )
+                if not blobs:
+                    break
+                AttachmentBlob.objects.filter(pk__in=[pk for pk, _ in blobs]).delete()
+                files = [name for _, name in blobs if name]
+                transaction.on_commit(
+                    lambda files=files: [storage.delete(name) for name in files]
+                )
+            removed += len(blobs)
+            time.sleep(options["pause"])
+        return removed
+
+    def sweep_files(self, batch_size):
+        storage = AttachmentBlob._meta.get_field("file").storage
+        # leave recent files alone, their blob row may not have committed yet
+        grace = timezone.now() - timedelta(hours=1)
+        removed = 0
+        batch = []
+        for name in self.walk(storage, "chat_blobs"):
+            if storage.get_modified_time(name) > grace:
+                continue
+            batch.append(name)
+            if len(batch) >= batch_size:
+                removed += self.delete_orphans(storage, batch)
+                batch = []
+        return removed + self.delete_orphans(storage, batch)
+
+    def delete_orphans(self, storage, names):
+        """Delete the files among ``names`` no blob refers to, in one query."""
+        referenced = set(
+            AttachmentBlob.objects.filter(file__in=names).values_list("file", flat=True)
+        )
+        orphans = [name for name in names if name not in referenced]
+        for name in orphans:
+            storage.delete(name)
+        return len(orphans)
+
+    def walk(self, storage, path):
+        if not storage.exists(path):
+            return
+        dirs, files = storage.listdir(path)
+        for d in dirs:
+            yield from self.walk(storage, f"{path}/{d}")
+        for f in files:
+            yield f"{path}/{f}"
@@ -0,0 +1,48 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatapi import startup
+
+
+class Command(BaseCommand):
+    help = (
+        "Cold-start an ASGI worker in a fresh interpreter and report the time "
+        "to its first response and the import time per module and package."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", default="/api/rooms/", help="Path of the first request")
+        parser.add_argument("--top", type=int, default=20, help="Number of modules to list")
+
+    def handle(self, *args, **options):
+        try:
+            report = startup.profile(options["path"])
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        imports = report["imports"]
+        packages = defaultdict(float)
+        for name, self_time, _ in imports:
+            packages[name.split(".")[0]] += self_time
+
+        self.stdout.write(f"{'module':<50} {'self ms':>9} {'cumul. ms':>10}")
+        slowest = sorted(imports, key=lambda m: -m[2])[: options["top"]]
+        for name, self_time, cumulative in slowest:
+            self.stdout.write(f"{name:<50} {self_time * 1e3:>9.1f} {cumulative * 1e3:>10.1f}")
+        self.stdout.write("")
+        self.stdout.write(f"{'package':<50} {'self ms':>9}")
+        for name, self_time in sorted(packages.items(), key=lambda p: -p[1])[: options["top"]]:
+            self.stdout.write(f"{name:<50} {self_time * 1e3:>9.1f}")
+        self.stdout.write("")
+        self.stdout.write(
+            f"{len(imports)} modules imported in {sum(m[1] for m in imports) * 1e3:.0f} ms "
+            "(measured with -X importtime, which adds overhead)"
+        )
+        self.stdout.write(f"Loading djchat.asgi:  {report['load'] * 1e3:.0f} ms")
+        self.stdout.write(
+            f"First request:        {report['first_request'] * 1e3:.0f} ms "
+            f"(GET {options['path']} -> {report['status']})"
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f"Time to first response: {report['cold_start'] * 1e3:.0f} ms")
+        )
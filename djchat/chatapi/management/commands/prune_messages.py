@@ -0,0 +1,117 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from chatapi.models import FileAttachment, Message, Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Enforce message retention (max age and/or max count, per room with global "
+        "defaults). Deletes in small indexed batches, each in its own short "
+        "transaction, so it is safe to run continuously next to writers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--pause", type=float, default=0.05,
+            help="Seconds to sleep between batches",
+        )
+        parser.add_argument(
+            "--loop", type=float, default=0, metavar="SECONDS",
+            help="Keep running, starting a new pass every SECONDS",
+        )
+        parser.add_argument(
+            "--sweep-files", action="store_true",
+            help="Also remove files under chat_files/ no attachment refers to",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            total = 0
+            for room in Room.objects.order_by("created_at").iterator(chunk_size=200):
+                total += self.prune_room(room, options)
+            self.stdout.write(self.style.SUCCESS(f"Pruned {total} messages"))
+            if options["sweep_files"]:
+                removed = self.sweep_files(options["batch_size"])
+                self.stdout.write(self.style.SUCCESS(f"Removed {removed} orphaned files"))
+            if not options["loop"]:
+                break
+            time.sleep(options["loop"])
+
+    def cutoff(self, room):
+        """Messages created at or before the returned time are past retention."""
+        cutoffs = []
+        days = room.retention_days or settings.CHAT_RETENTION_DAYS
+        if days:
+            cutoffs.append(timezone.now() - timedelta(days=days))
+        max_messages = room.retention_max_messages or settings.CHAT_RETENTION_MAX_MESSAGES
+        if max_messages:
+            # created_at of the newest message that no longer fits (room, created_at
+            # index). Tombstones don't count: they'd take the place of real messages,
+            # and they go along with the messages around them
+            oldest_kept = (
+                Message.objects.filter(room=room, deleted_at__isnull=True)
+                .order_by("-created_at")
+                .values_list("created_at", flat=True)[max_messages : max_messages + 1]
+            )
+            cutoffs.extend(oldest_kept)
+        return max(cutoffs) if cutoffs else None
+
+    def prune_room(self, room, options):
+        cutoff = self.cutoff(room)
+        if cutoff is None:
+            return 0
+        done = 0
+        while True:
+            with transaction.atomic():
+                ids = list(
+                    Message.objects.filter(room=room, created_at__lte=cutoff)
+                    .order_by("created_at")
+                    .values_list("id", flat=True)[: options["batch_size"]]
+                )
+                if not ids:
+                    break
+                done += Message.purge(ids)
+            self.stdout.write(f"Room {room.id}: {done} messages pruned")
+            time.sleep(options["pause"])
+        return done
+
+    def sweep_files(self, batch_size):
+        storage = FileAttachment._meta.get_field("file").storage
+        # leave recent files alone, their upload may not have committed yet
+        grace = timezone.now() - timedelta(hours=1)
+        removed = 0
+        batch = []
+        for name in self.walk(storage, "chat_files"):
+            if storage.get_modified_time(name) > grace:
+                continue
+            batch.append(name)
+            if len(batch) >= batch_size:
+                removed += self.delete_orphans(storage, batch)
+                batch = []
+        return removed + self.delete_orphans(storage, batch)
+
+    def delete_orphans(self, storage, names):
+        """Delete the files among ``names`` no attachment refers to, in one query."""
+        referenced = set(
+            FileAttachment.objects.filter(file__in=names).values_list("file", flat=True)
+        )
+        orphans = [name for name in names if name not in referenced]
+        for name in orphans:
+            storage.delete(name)
+        return len(orphans)
+
+    def walk(self, storage, path):
+        if not storage.exists(path):
+            return
+        dirs, files = storage.listdir(path)
+        for d in dirs:
+            yield from self.walk(storage, f"{path}/{d}")
+        for f in files:
+            yield f"{path}/{f}"
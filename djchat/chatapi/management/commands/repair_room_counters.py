@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chatapi.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the denormalized Room counters (member_count, message_count, "
+        "last_message, last_message_at) from the membership and message tables. "
+        "Runs in small batches of rooms, each in its own short transaction."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("room_ids", nargs="*", help="Only these rooms (default: all)")
+        parser.add_argument("--batch-size", type=int, default=200)
+        parser.add_argument(
+            "--pause", type=float, default=0.05,
+            help="Seconds to sleep between batches",
+        )
+
+    def handle(self, *args, **options):
+        rooms = Room.objects.order_by("pk")
+        if options["room_ids"]:
+            rooms = rooms.filter(pk__in=options["room_ids"])
+        ids = list(rooms.values_list("pk", flat=True))
+        size = options["batch_size"]
+        drifted = 0
+        for start in range(0, len(ids), size):
+            batch = ids[start : start + size]
+            with transaction.atomic():
+                before = self.counters(batch)
+                Room.refresh_counters(batch)
+                after = self.counters(batch)
+            drifted += sum(1 for pk in batch if before[pk] != after[pk])
+            time.sleep(options["pause"])
+        self.stdout.write(
+            self.style.SUCCESS(f"Checked {len(ids)} rooms, repaired {drifted}")
+        )
+
+    def counters(self, room_ids):
+        return {
+            row[0]: row[1:]
+            for row in Room.objects.filter(pk__in=room_ids).values_list(
+                "pk", "member_count", "message_count", "last_message", "last_message_at"
+            )
+        }
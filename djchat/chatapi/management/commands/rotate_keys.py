@@ -0,0 +1,125 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from chatapi.crypto import decrypt_with_room_key, encrypt_with_room_key
+from chatapi.models import CompressionDictionary, Message, Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Rotate encryption keys online. --rewrap re-wraps room keys and compression "
+        "dictionaries under the current SERVER_MASTER_KEY, --new-room-key starts a "
+        "new room key version, and "
+        "--reencrypt moves messages onto the current room key in small throttled "
+        "batches. Re-encryption is resumable: it only picks up stale messages."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("room_ids", nargs="*", help="Limit to these rooms")
+        parser.add_argument(
+            "--rewrap", action="store_true",
+            help="Re-wrap room keys and compression dictionaries with the master key",
+        )
+        parser.add_argument(
+            "--new-room-key", action="store_true",
+            help="Generate a new room key version for the selected rooms",
+        )
+        parser.add_argument(
+            "--reencrypt", action="store_true",
+            help="Re-encrypt messages still using an old room key version",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--max-rate", type=float, default=2000,
+            help="CPU budget: maximum messages re-encrypted per second",
+        )
+        parser.add_argument(
+            "--pause", type=float, default=0.05,
+            help="I/O budget: minimum seconds to sleep between batches",
+        )
+
+    def handle(self, *args, **options):
+        if not (options["rewrap"] or options["new_room_key"] or options["reencrypt"]):
+            raise CommandError("Pass at least one of --rewrap, --new-room-key, --reencrypt")
+        # E2E rooms have no server-side key to rotate; their clients do it
+        rooms = Room.objects.filter(e2e=False).order_by("created_at")
+        if options["room_ids"]:
+            rooms = rooms.filter(id__in=options["room_ids"])
+
+        if options["rewrap"]:
+            count = 0
+            for room in rooms.iterator(chunk_size=200):
+                with transaction.atomic():
+                    room.rewrap_keys()
+                count += 1
+            self.stdout.write(f"Re-wrapped keys of {count} rooms")
+            # dictionaries are made of message fragments: the same master key
+            dictionaries = CompressionDictionary.objects.order_by("pk")
+            if options["room_ids"]:
+                dictionaries = dictionaries.filter(room_id__in=options["room_ids"])
+            count = 0
+            for dictionary in dictionaries.iterator(chunk_size=200):
+                dictionary.rewrap()
+                count += 1
+            self.stdout.write(f"Re-wrapped {count} compression dictionaries")
+
+        if options["new_room_key"]:
+            for room in rooms.iterator(chunk_size=200):
+                version = room.rotate_room_key()
+                self.stdout.write(f"Room {room.id}: now on key version {version}")
+
+        if options["reencrypt"]:
+            stale_rooms = rooms.filter(old_keys__isnull=False).distinct()
+            total = 0
+            for room in stale_rooms.iterator(chunk_size=200):
+                total += self.reencrypt_room(room, options)
+            self.stdout.write(self.style.SUCCESS(f"Re-encrypted {total} messages"))
+
+    def reencrypt_room(self, room, options):
+        batch_size = options["batch_size"]
+        min_batch_time = batch_size / options["max_rate"]
+        current_key = room.get_room_key()
+        failed = set()
+        done = 0
+        while True:
+            started = time.monotonic()
+            # each batch is its own short transaction so writers are never
+            # blocked for long; finished rows drop out of the stale filter.
+            # The rows stay locked until the write, so an edit or delete in
+            # between can't be overwritten with the old content. Tombstones
+            # have no content left to move.
+            with transaction.atomic():
+                batch = list(
+                    Message.objects.select_for_update()
+                    .filter(
+                        room=room, key_version__lt=room.key_version, deleted_at__isnull=True
+                    )
+                    .exclude(id__in=failed)
+                    .only("id", "ciphertext", "nonce", "key_version")[:batch_size]
+                )
+                if not batch:
+                    break
+                updated = []
+                for m in batch:
+                    try:
+                        pt = decrypt_with_room_key(
+                            room.get_room_key(m.key_version),
+                            bytes(m.ciphertext),
+                            bytes(m.nonce),
+                        )
+                    except Exception:
+                        failed.add(m.id)
+                        continue
+                    m.ciphertext, m.nonce = encrypt_with_room_key(current_key, pt)
+                    m.key_version = room.key_version
+                    updated.append(m)
+                Message.objects.bulk_update(updated, ["ciphertext", "nonce", "key_version"])
+            done += len(updated)
+            self.stdout.write(f"Room {room.id}: {done} messages re-encrypted")
+            elapsed = time.monotonic() - started
+            time.sleep(max(options["pause"], min_batch_time - elapsed))
+        if failed:
+            self.stderr.write(f"Room {room.id}: {len(failed)} messages could not be decrypted")
+        return done
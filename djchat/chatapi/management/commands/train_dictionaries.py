@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatapi import compression
+from chatapi.models import CompressionDictionary, Message, Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Train zstd dictionaries for message compression on recent messages, per "
+        "room and/or one global dictionary for rooms without their own. New "
+        "messages use the newest dictionary; older ones stay readable."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "room_ids", nargs="*", help="Train per-room dictionaries for these rooms"
+        )
+        parser.add_argument(
+            "--global", action="store_true", dest="global_",
+            help="Train a global dictionary on messages from all rooms",
+        )
+        parser.add_argument("--size", type=int, default=16384, help="Dictionary size in bytes")
+        parser.add_argument(
+            "--samples", type=int, default=10000,
+            help="Number of recent messages to train on",
+        )
+        parser.add_argument(
+            "--min-samples", type=int, default=500,
+            help="Skip rooms with fewer messages than this",
+        )
+
+    def handle(self, *args, **options):
+        if compression.zstandard is None:
+            raise CommandError("zstandard is not installed")
+        if not (options["room_ids"] or options["global_"]):
+            raise CommandError("Pass room ids and/or --global")
+
+        for room in Room.objects.filter(id__in=options["room_ids"], e2e=False):
+            self.train(Message.objects.filter(room=room), options, room=room)
+        if options["global_"]:
+            self.train(Message.objects.filter(room__e2e=False), options)
+
+    def train(self, messages, options, room=None):
+        label = f"Room {room.id}" if room else "Global"
+        rooms = {}
+        samples = []
+        recent = (
+            messages.filter(deleted_at__isnull=True)
+            .select_related("room")
+            .order_by("-created_at")[: options["samples"]]
+        )
+        for m in recent.iterator(chunk_size=500):
+            # one Room instance per room so its unwrapped keys are cached
+            samples.append(m.decrypt(rooms.setdefault(m.room_id, m.room)))
+        if len(samples) < options["min_samples"]:
+            self.stdout.write(f"{label}: only {len(samples)} messages, skipped")
+            return
+        data = compression.train(samples, options["size"])
+        dictionary = CompressionDictionary.create(data, room=room)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{label}: dictionary {dictionary.pk} ({len(data)} bytes) "
+                f"trained on {len(samples)} messages"
+            )
+        )
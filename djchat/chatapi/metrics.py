@@ -0,0 +1,33 @@
+"""
+Counters shared by all nodes, kept in one Valkey hash (no TTL, so it is not
+an eviction candidate). Read them with `manage.py chat_metrics`.
+"""
+import logging
+
+from .valkey import get_async_valkey, get_valkey
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = "djchat:metrics"
+
+
+async def aincr(name, amount=1):
+    try:
+        await get_async_valkey().hincrby(METRICS_KEY, name, amount)
+    except Exception:
+        logger.warning("Could not record metric %s", name, exc_info=True)
+
+
+def incr(name, amount=1):
+    try:
+        get_valkey().hincrby(METRICS_KEY, name, amount)
+    except Exception:
+        logger.warning("Could not record metric %s", name, exc_info=True)
+
+
+def snapshot() -> dict:
+    return {k: int(v) for k, v in get_valkey().hgetall(METRICS_KEY).items()}
+
+
+def reset():
+    get_valkey().delete(METRICS_KEY)
@@ -1,23 +1,45 @@
 # Create your models here.
+import hashlib
+import hmac
 import os
 import uuid
+from collections import Counter, defaultdict
+from functools import lru_cache, partial
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
 from django.contrib.auth import get_user_model
-from cryptography.fernet import Fernet, InvalidToken
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+
+from . import directory
+from .compression import decode_body, encode_body
+from .crypto import decrypt_with_room_key, encrypt_with_room_key
 
 User = get_user_model()
 
 
 def _master_fernet():
-    # SERVER_MASTER_KEY must be a urlsafe_base64-encoded 32-byte key
+    # SERVER_MASTER_KEY must be a urlsafe_base64-encoded 32-byte key.
+    # Retired keys in SERVER_OLD_MASTER_KEYS still decrypt, so the master key
+    # can be rotated online and room keys and compression dictionaries re-wrapped
+    # with `rotate_keys --rewrap`.
     key = settings.SERVER_MASTER_KEY
     if not key:
         raise RuntimeError("SERVER_MASTER_KEY not set")
-    # Ensure key is bytes
-    if isinstance(key, str):
-        key = key.encode('utf-8')
-    return Fernet(key)
+    return _multi_fernet(key, tuple(settings.SERVER_OLD_MASTER_KEYS))
+
+
+@lru_cache(maxsize=4)
+def _multi_fernet(key, old_keys):
+    # built once per key set (and at startup, see startup.warm)
+    keys = [key, *old_keys]
+    # Ensure keys are bytes
+    return MultiFernet(
+        [Fernet(k.encode("utf-8") if isinstance(k, str) else k) for k in keys]
+    )
 
 
 def gen_room_key_bytes():
@@ -35,29 +57,276 @@ class Room(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     description = models.TextField(blank=True, null=True)
 
-    # encrypted_room_key stores the room symmetric key encrypted with server master key
+    # encrypted_room_key stores the current room symmetric key encrypted with
+    # server master key; earlier versions are kept in RoomKey after a rotation
     encrypted_room_key = models.BinaryField(null=False)
+    key_version = models.PositiveIntegerField(default=1)
+
+    # end-to-end mode: clients encrypt and decrypt, the server only stores and
+    # relays ciphertext. It never has the room key (encrypted_room_key is
+    # empty); clients wrap it for each member with their public key (MemberRoomKey)
+    e2e = models.BooleanField(default=False)
+
+    # retention policy; null falls back to CHAT_RETENTION_DAYS / CHAT_RETENTION_MAX_MESSAGES
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+    retention_max_messages = models.PositiveIntegerField(null=True, blank=True)
+
+    # bumped on every message create / edit / delete, see Message.seq
+    change_seq = models.BigIntegerField(default=0)
+
+    # denormalized, kept up to date by the membership and message write paths
+    # (`repair_room_counters` fixes any drift); message_count and last_message
+    # only count live (not deleted) messages
+    member_count = models.PositiveIntegerField(default=0)
+    message_count = models.PositiveIntegerField(default=0)
+    last_message = models.ForeignKey(
+        "Message", on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True)
 
     @classmethod
     def create_with_key(cls, **kwargs):
-        # generate room key, encrypt and store
-        room_key = gen_room_key_bytes()
-        f = _master_fernet()
-        encrypted = f.encrypt(room_key)
+        # generate room key, encrypt and store (E2E rooms: the clients do this)
+        if kwargs.get("e2e"):
+            encrypted = b""
+        else:
+            encrypted = _master_fernet().encrypt(gen_room_key_bytes())
         if "id" not in kwargs:
             kwargs["id"] = uuid.uuid4()
         room = cls(encrypted_room_key=encrypted, **kwargs)
         room.save()
         return room
 
-    def get_room_key(self):
+    def add_members(self, usernames, invited_by):
+        """
+        Add users to the room by username with set-based writes.
+        Returns (added_users, unknown_usernames); existing members are skipped.
+        """
+        wanted = set(usernames)
+        users = list(User.objects.filter(username__in=wanted))
+        unknown = sorted(wanted - {u.username for u in users})
+        existing = set(
+            Membership.objects.filter(room=self, user__in=users).values_list(
+                "user_id", flat=True
+            )
+        )
+        added = [u for u in users if u.id not in existing]
+        Membership.objects.bulk_create(
+            [Membership(room=self, user=u, invited_by=invited_by) for u in added],
+            ignore_conflicts=True,
+        )
+        Room.refresh_counters([self.pk], ["member_count"])
+        self.refresh_from_db(fields=["member_count"])
+        if added:
+            self.members_changed()
+        return added, unknown
+
+    def remove_members(self, usernames):
+        """
+        Remove users from the room by username in one DELETE.
+        Returns (removed_user_ids, unknown_usernames). The creator is never removed.
+        """
+        wanted = set(usernames)
+        members = list(
+            Membership.objects.filter(room=self, user__username__in=wanted)
+            .exclude(user_id=self.created_by_id)
+            .values_list("user_id", "user__username")
+        )
+        known = set(
+            User.objects.filter(username__in=wanted).values_list("username", flat=True)
+        )
+        removed_ids = [user_id for user_id, _ in members]
+        Membership.objects.filter(room=self, user_id__in=removed_ids).delete()
+        MemberRoomKey.objects.filter(room=self, user_id__in=removed_ids).delete()
+        Room.refresh_counters([self.pk], ["member_count"])
+        self.refresh_from_db(fields=["member_count"])
+        if removed_ids:
+            self.members_changed()
+        return removed_ids, sorted(wanted - known)
+
+    def members_changed(self):
+        """Invalidate the cached member directory once the change is committed."""
+        transaction.on_commit(partial(directory.bump_version, self.pk))
+
+    COUNTER_FIELDS = ("member_count", "message_count", "last_message")
+
+    @classmethod
+    def refresh_counters(cls, room_ids, fields=COUNTER_FIELDS):
+        """
+        Recompute denormalized counters of the given rooms from the source
+        tables in one UPDATE ("last_message" also sets last_message_at).
+        """
+        live = Message.objects.filter(deleted_at__isnull=True)
+        latest = live.filter(room=OuterRef("pk")).order_by("-created_at")
+        updates = {}
+        if "member_count" in fields:
+            updates["member_count"] = _count_per_room(Membership.objects.all())
+        if "message_count" in fields:
+            updates["message_count"] = _count_per_room(live)
+        if "last_message" in fields:
+            updates["last_message"] = Subquery(latest.values("id")[:1])
+            updates["last_message_at"] = Subquery(latest.values("created_at")[:1])
+        return cls.objects.filter(pk__in=room_ids).update(**updates)
+
+    def next_seq(self):
+        """Bump and return the room's change sequence. Call inside a transaction."""
+        Room.objects.filter(pk=self.pk).update(change_seq=F("change_seq") + 1)
+        self.change_seq = Room.objects.values_list("change_seq", flat=True).get(pk=self.pk)
+        return self.change_seq
+
+    def get_room_key(self, version=None):
+        """Unwrap the room key for ``version`` (default: current), cached per instance."""
+        if self.e2e:
+            raise RuntimeError("End-to-end encrypted room: the server has no room key")
+        if version is None:
+            version = self.key_version
+        cache = self.__dict__.setdefault("_room_keys", {})
+        if version in cache:
+            return cache[version]
+        if version == self.key_version:
+            encrypted = self.encrypted_room_key
+        else:
+            encrypted = self.old_keys.get(version=version).encrypted_key
         f = _master_fernet()
         try:
-            room_key = f.decrypt(bytes(self.encrypted_room_key))
+            room_key = f.decrypt(bytes(encrypted))
         except InvalidToken:
             raise RuntimeError("Failed to decrypt room key")
+        cache[version] = room_key
         return room_key  # raw bytes
 
+    def rotate_room_key(self):
+        """
+        Start using a fresh room key. The previous key is archived in RoomKey so
+        existing messages stay readable until `rotate_keys` re-encrypts them.
+        """
+        with transaction.atomic():
+            room = Room.objects.select_for_update().get(pk=self.pk)
+            RoomKey.objects.create(
+                room=room,
+                version=room.key_version,
+                encrypted_key=room.encrypted_room_key,
+            )
+            room.encrypted_room_key = _master_fernet().encrypt(gen_room_key_bytes())
+            room.key_version += 1
+            room.save(update_fields=["encrypted_room_key", "key_version"])
+        self.encrypted_room_key = room.encrypted_room_key
+        self.key_version = room.key_version
+        return self.key_version
+
+    def rewrap_keys(self):
+        """Re-encrypt the current and archived room keys under the primary master key."""
+        f = _master_fernet()
+        with transaction.atomic():
+            # locked and re-read like in rotate_room_key, so a key rotated since
+            # this instance was loaded is not overwritten with the old one
+            room = Room.objects.select_for_update().get(pk=self.pk)
+            room.encrypted_room_key = f.rotate(bytes(room.encrypted_room_key))
+            room.save(update_fields=["encrypted_room_key"])
+            for old in room.old_keys.select_for_update():
+                old.encrypted_key = f.rotate(bytes(old.encrypted_key))
+                old.save(update_fields=["encrypted_key"])
+        self.encrypted_room_key = room.encrypted_room_key
+        self.key_version = room.key_version
+
+    def store_member_keys(self, user, version, wrapped_keys):
+        """
+        Store client-wrapped keys of an E2E room ({username: wrapped key bytes})
+        uploaded by ``user``. ``version`` is the current key version, or
+        key_version + 1 to start a new room key (e.g. after removing a member),
+        which only the room creator or an upload wrapping it for every member
+        may do. A key already stored for this version is only replaced for
+        ``user`` themselves. Returns the usernames that were skipped: not
+        members, or members who already have a key for this version.
+        """
+        with transaction.atomic():
+            room = Room.objects.select_for_update().get(pk=self.pk)
+            if version not in (room.key_version, room.key_version + 1):
+                raise ValueError(
+                    f"key_version must be {room.key_version} or {room.key_version + 1}"
+                )
+            members = dict(
+                Membership.objects.filter(room=room).values_list("user__username", "user_id")
+            )
+            if (
+                version > room.key_version
+                and user.id != room.created_by_id
+                and not members.keys() <= wrapped_keys.keys()
+            ):
+                raise PermissionError(
+                    "Only the room creator can start a new key version without "
+                    "wrapping it for every member"
+                )
+            has_key = set(
+                MemberRoomKey.objects.filter(room=room, version=version)
+                .exclude(user=user)
+                .values_list("user_id", flat=True)
+            )
+            stored = {
+                username: user_id
+                for username, user_id in members.items()
+                if username in wrapped_keys and user_id not in has_key
+            }
+            MemberRoomKey.objects.bulk_create(
+                [
+                    MemberRoomKey(
+                        room=room, user_id=user_id, version=version,
+                        wrapped_key=wrapped_keys[username],
+                    )
+                    for username, user_id in stored.items()
+                ],
+                update_conflicts=True,
+                unique_fields=["room", "user", "version"],
+                update_fields=["wrapped_key"],
+            )
+            if version > room.key_version:
+                room.key_version = version
+                room.save(update_fields=["key_version"])
+        self.key_version = room.key_version
+        return sorted(set(wrapped_keys) - set(stored))
+
+
+def _count_per_room(queryset):
+    # correlated COUNT(*) for the outer Room row (no rows -> 0, not NULL)
+    counts = (
+        queryset.filter(room=OuterRef("pk"))
+        .order_by()
+        .values("room")
+        .annotate(n=Count("pk"))
+        .values("n")
+    )
+    return Coalesce(Subquery(counts), 0)
+
+
+class RoomKey(models.Model):
+    """Archived (no longer current) room key versions."""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="old_keys")
+    version = models.PositiveIntegerField()
+    encrypted_key = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("room", "version")
+
+
+class UserPublicKey(models.Model):
+    """A user's public key; clients use it to wrap E2E room keys for that user."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="public_key")
+    public_key = models.TextField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class MemberRoomKey(models.Model):
+    """An E2E room key version, wrapped by a client for one member. Opaque to the server."""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="member_keys")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    version = models.PositiveIntegerField()
+    wrapped_key = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("room", "user", "version")
+
 
 class Membership(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="memberships")
@@ -79,31 +348,262 @@ class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     ciphertext = models.BinaryField()  # encrypted message bytes
     nonce = models.BinaryField(null=True, blank=True)  # if using AES-GCM with nonce
+    key_version = models.PositiveIntegerField(default=1)  # room key version used
     created_at = models.DateTimeField(auto_now_add=True)
+    # room change_seq of the last create / edit / delete of this message
+    seq = models.BigIntegerField(default=0)
+    edited_at = models.DateTimeField(null=True, blank=True)
+    # tombstone: set when deleted, ciphertext is wiped but the row is kept
+    # so `rooms/<id>/changes/` can report the deletion
+    deleted_at = models.DateTimeField(null=True, blank=True)
     #attachments = models.ManyToManyField(
     #    "FileAttachment", related_name="messages", blank=True
     #)
     # add delivered/read booleans as needed
 
+    @classmethod
+    def create_encrypted(cls, room, sender, plaintext: bytes):
+        """Compress, encrypt with the current room key and store with the next room seq."""
+        ct, nonce = encrypt_with_room_key(room.get_room_key(), encode_body(plaintext, room.pk))
+        return cls.create_opaque(room, sender, ct, nonce, room.key_version)
+
+    @classmethod
+    def create_opaque(cls, room, sender, ciphertext: bytes, nonce: bytes, key_version: int):
+        """Store already encrypted content (E2E rooms) with the next room seq."""
+        with transaction.atomic():
+            msg = cls.objects.create(
+                room=room,
+                sender=sender,
+                ciphertext=ciphertext,
+                nonce=nonce,
+                key_version=key_version,
+                seq=room.next_seq(),
+            )
+            # the room row is already locked by next_seq()
+            Room.objects.filter(pk=room.pk).update(
+                message_count=F("message_count") + 1,
+                last_message=msg,
+                last_message_at=msg.created_at,
+            )
+        return msg
+
+    def decrypt(self, room=None) -> bytes:
+        """Plaintext body. Pass the room to reuse its cached keys."""
+        room = room or self.room
+        body = decrypt_with_room_key(
+            room.get_room_key(self.key_version), bytes(self.ciphertext), bytes(self.nonce)
+        )
+        return decode_body(body)
+
+    def edit(self, plaintext: bytes):
+        room = self.room
+        ct, nonce = encrypt_with_room_key(room.get_room_key(), encode_body(plaintext, room.pk))
+        self.edit_opaque(ct, nonce, room.key_version)
+
+    def edit_opaque(self, ciphertext: bytes, nonce: bytes, key_version: int):
+        """Replace the content with already encrypted content (E2E rooms)."""
+        self.ciphertext, self.nonce = ciphertext, nonce
+        self.key_version = key_version
+        self.edited_at = timezone.now()
+        with transaction.atomic():
+            self.seq = self.room.next_seq()
+            self.save(update_fields=["ciphertext", "nonce", "key_version", "edited_at", "seq"])
+
+    def tombstone(self):
+        """Delete the content and attachments but keep the row as a tombstone."""
+        with transaction.atomic():
+            attachments = self.attachments.all()
+            FileAttachment.release(attachments)
+            attachments.delete()
+            self.ciphertext = b""
+            self.nonce = None
+            self.deleted_at = timezone.now()
+            self.seq = self.room.next_seq()
+            self.save(update_fields=["ciphertext", "nonce", "deleted_at", "seq"])
+            Room.objects.filter(pk=self.room_id).update(
+                message_count=Greatest(F("message_count") - 1, 0)
+            )
+            Room.refresh_counters([self.room_id], ["last_message"])
+
+    @classmethod
+    def purge(cls, message_ids):
+        """
+        Hard delete messages with their attachments, releasing the attachment
+        files once the transaction commits. Returns rows deleted.
+        """
+        FileAttachment.release(FileAttachment.objects.filter(message_id__in=message_ids))
+        live_per_room = dict(
+            cls.objects.filter(id__in=message_ids)
+            .order_by()
+            .values("room")
+            .annotate(n=Count("pk", filter=models.Q(deleted_at__isnull=True)))
+            .values_list("room", "n")
+        )
+        _, per_model = cls.objects.filter(id__in=message_ids).delete()
+        for room_id, n in live_per_room.items():
+            if n:
+                Room.objects.filter(pk=room_id).update(
+                    message_count=Greatest(F("message_count") - n, 0)
+                )
+        Room.refresh_counters(live_per_room, ["last_message"])
+        return per_model.get(cls._meta.label, 0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["room", "key_version"]),
+            models.Index(fields=["room", "created_at"]),
+            models.Index(fields=["room", "seq"]),
+        ]
+
+
+class CompressionDictionary(models.Model):
+    """
+    zstd dictionary for message bodies, trained on a room's messages (room
+    null: global). Stored bodies refer to it by id, so it is never changed;
+    train a new one instead. The data is encrypted with the server master key
+    since it is made of message fragments.
+    """
+    room = models.ForeignKey(
+        Room, on_delete=models.CASCADE, null=True, blank=True,
+        related_name="compression_dictionaries",
+    )
+    encrypted_data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def create(cls, data: bytes, room=None):
+        return cls.objects.create(room=room, encrypted_data=_master_fernet().encrypt(data))
+
+    def get_data(self) -> bytes:
+        return _master_fernet().decrypt(bytes(self.encrypted_data))
+
+    def rewrap(self):
+        """Re-encrypt the data under the primary master key."""
+        self.encrypted_data = _master_fernet().rotate(bytes(self.encrypted_data))
+        self.save(update_fields=["encrypted_data"])
+
+
+class AttachmentBlob(models.Model):
+    """
+    Attachment content, stored once per room under a keyed hash of the
+    content (see digest()). ref_count is the number of FileAttachment rows
+    using it; `gc_attachments` removes blobs nothing refers to anymore.
+    """
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name="attachment_blobs")
+    digest = models.CharField(max_length=64)
+    file = models.FileField(upload_to="chat_blobs/")
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("room", "digest")
+
+    @staticmethod
+    def digest_of(room, chunks) -> str:
+        # HMAC with a per-room key derived from SECRET_KEY: equal files match
+        # within a room, but a digest says nothing about other rooms' files
+        key = salted_hmac("chatapi.AttachmentBlob", str(room.pk), algorithm="sha256").digest()
+        h = hmac.new(key, digestmod=hashlib.sha256)
+        for chunk in chunks:
+            h.update(chunk)
+        return h.hexdigest()
+
+    @classmethod
+    def acquire(cls, room, uploaded_file):
+        """
+        Blob holding the uploaded content, with one more reference. The upload
+        is only written to storage if the room doesn't have this content yet.
+        """
+        digest = cls.digest_of(room, uploaded_file.chunks())
+        with transaction.atomic():
+            blob, created = cls.objects.select_for_update().get_or_create(
+                room=room, digest=digest, defaults={"size": uploaded_file.size}
+            )
+            if created:
+                storage = cls._meta.get_field("file").storage
+                name = f"chat_blobs/{room.pk}/{digest[:2]}/{digest}"
+                blob.file = storage.save(name, uploaded_file)
+                blob.save(update_fields=["file"])
+            cls.objects.filter(pk=blob.pk).update(ref_count=F("ref_count") + 1)
+        return blob
+
+    @classmethod
+    def release(cls, counts):
+        """Drop references: ``counts`` maps blob id to the number released."""
+        by_count = defaultdict(list)
+        for blob_id, n in counts.items():
+            by_count[n].append(blob_id)
+        for n, blob_ids in by_count.items():
+            cls.objects.filter(pk__in=blob_ids).update(
+                ref_count=Greatest(F("ref_count") - n, 0)
+            )
+
 
 class FileAttachment(models.Model):
     id = models.UUIDField(primary_key=True, editable=False, default=uuid.uuid4)
     message = models.ForeignKey(
         Message, on_delete=models.CASCADE, related_name="attachments"
     )
+    # shared content of the room (file is then the blob's file); null for
+    # attachments uploaded before deduplication, which own their file.
+    # RESTRICT: a blob in use can't be deleted on its own, but goes together
+    # with its attachments when their room (or its creator) is deleted
+    blob = models.ForeignKey(
+        AttachmentBlob, on_delete=models.RESTRICT, null=True, blank=True,
+        related_name="attachments",
+    )
     file = models.FileField(upload_to="chat_files/%Y/%m/%d/")
     encrypted_filename = models.BinaryField()  # encrypted original filename
     file_size = models.BigIntegerField()  # in bytes
     content_type = models.CharField(max_length=100)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
+    @classmethod
+    def create_deduplicated(cls, message, uploaded_file, **fields):
+        """Attach an upload via the room's blob store (no write if the content is known)."""
+        blob = AttachmentBlob.acquire(message.room, uploaded_file)
+        return cls.objects.create(
+            message=message, blob=blob, file=blob.file.name, file_size=blob.size, **fields
+        )
+
+    @classmethod
+    def release(cls, attachments):
+        """
+        Let go of the files of attachments that are about to be deleted: blob
+        references are dropped, files owned by older attachments are deleted
+        once the transaction commits.
+        """
+        rows = list(attachments.values_list("blob_id", "file"))
+        AttachmentBlob.release(Counter(blob_id for blob_id, _ in rows if blob_id))
+        files = [name for blob_id, name in rows if not blob_id and name]
+        if files:
+            storage = cls._meta.get_field("file").storage
+            transaction.on_commit(lambda: [storage.delete(name) for name in files])
+
     def get_original_filename(self, room_key: bytes) -> str:
         """Decrypt and return the original filename"""
-        from .crypto import decrypt_with_room_key
-
         # For filename, we'll use a static nonce (not ideal but simple)
         # In production, store nonce separately
         nonce = b"0" * 12  # placeholder
         return decrypt_with_room_key(
             room_key, bytes(self.encrypted_filename), nonce
         ).decode()
+
+
+class ReplicaHeartbeat(models.Model):
+    """
+    A single row the primary rewrites every few seconds (see dbrouter). How
+    old a replica's copy of it is tells how far that replica lags behind.
+    """
+    beat = models.DateTimeField()
+
+    @classmethod
+    def write(cls):
+        now = timezone.now()
+        cls.objects.using("default").update_or_create(pk=1, defaults={"beat": now})
+        return now
+
+    @classmethod
+    def read(cls, alias):
+        return cls.objects.using(alias).filter(pk=1).values_list("beat", flat=True).first()
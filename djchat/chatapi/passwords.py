@@ -0,0 +1,91 @@
+"""
+Password hashing off the request path.
+
+PBKDF2 runs in a bounded process pool so a login burst burns CPU in the pool
+workers instead of the ASGI workers serving the rest of the API. When the
+pool's queue is full, callers get ``HashingBusy`` and should shed the request.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import (
+    PBKDF2PasswordHasher,
+    get_hasher,
+    identify_hasher,
+    make_password,
+)
+
+
+class ConfigurablePBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    PBKDF2-SHA256 with the cost taken from ``settings.AUTH_PBKDF2_ITERATIONS``.
+    Keeps Django's algorithm name, so existing hashes verify and are upgraded
+    on the next successful login when the configured cost changes.
+    """
+
+    @property
+    def iterations(self):
+        return settings.AUTH_PBKDF2_ITERATIONS
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def _init_worker(settings_module):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+    django.setup()
+
+
+def _verify(password, encoded):
+    """Runs in a pool worker. Returns (valid, upgraded hash or None)."""
+    try:
+        hasher = identify_hasher(encoded)
+    except ValueError:
+        return False, None
+    if not hasher.verify(password, encoded):
+        return False, None
+    preferred = get_hasher()
+    if hasher.algorithm != preferred.algorithm or preferred.must_update(encoded):
+        return True, make_password(password)
+    return True, None
+
+
+_pool = None
+_pending = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.AUTH_HASH_WORKERS,
+            # fork is unsafe in a threaded ASGI process; workers set Django up themselves
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(os.environ["DJANGO_SETTINGS_MODULE"],),
+        )
+    return _pool
+
+
+async def _run(fn, *args):
+    global _pending
+    if _pending is None:
+        _pending = asyncio.Semaphore(settings.AUTH_HASH_MAX_PENDING)
+    if _pending.locked():
+        raise HashingBusy()
+    async with _pending:
+        return await asyncio.wrap_future(_get_pool().submit(fn, *args))
+
+
+async def averify_password(password, encoded):
+    """Check a password against a stored hash; see ``_verify``."""
+    return await _run(_verify, password, encoded)
+
+
+async def ahash_password(password):
+    return await _run(make_password, password)
@@ -0,0 +1,235 @@
+"""
+Valkey token-bucket rate limiting.
+
+All buckets of one check are evaluated by a single Lua script, so a check is
+one round trip no matter how many buckets (per IP, per user, ...) it touches.
+Tokens are only taken when every bucket allows the request.
+
+Hot paths (message posts, WebSocket actions) use ``hit_leased``: when the same
+buckets are checked again within LEASE_TTL, the process takes a small batch of
+tokens at once and spends them locally, so a busy client costs well under one
+round trip per check. Leased tokens are already gone from Valkey, so leasing
+can only make a limit stricter, never looser.
+"""
+import logging
+import threading
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+
+from .valkey import get_async_valkey, get_valkey
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "djchat:rl:"
+
+# KEYS: one hash per bucket. ARGV: cost, then (rate per second, burst) per key.
+# Returns 0 when allowed, otherwise the seconds to wait (as a string).
+TOKEN_BUCKET_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local cost = tonumber(ARGV[1])
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local level = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    level = math.min(burst, level + math.max(0, now - ts) * rate)
+    tokens[i] = level
+    if level < cost then
+        wait = math.max(wait, (cost - level) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local level = tokens[i]
+    if wait == 0 then
+        level = level - cost
+    end
+    redis.call('HSET', key, 'tokens', level, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+return tostring(wait)
+"""
+
+# KEYS/ARGV as above, but ARGV[1] is the most tokens to take. Takes as many
+# whole tokens as every bucket has, up to that. Returns {granted, wait}.
+LEASE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local grant = tonumber(ARGV[1])
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local level = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    level = math.min(burst, level + math.max(0, now - ts) * rate)
+    levels[i] = level
+    grant = math.min(grant, math.floor(level))
+end
+local wait = 0
+if grant < 1 then
+    grant = 0
+    for i, level in ipairs(levels) do
+        wait = math.max(wait, (1 - level) / tonumber(ARGV[i * 2]))
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    redis.call('HSET', key, 'tokens', levels[i] - grant, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+return {grant, tostring(wait)}
+"""
+
+# seconds a leased batch of tokens stays usable (and a key counts as busy)
+LEASE_TTL = 1.0
+
+PERIODS = {"s": 1, "sec": 1, "m": 60, "min": 60, "h": 3600, "hour": 3600, "d": 86400, "day": 86400}
+
+
+class Bucket(NamedTuple):
+    key: str
+    rate: float  # tokens refilled per second
+    burst: int  # bucket size
+
+
+def parse_rate(rate: str) -> tuple[float, int]:
+    """Parse a DRF style rate such as ``"30/min"`` into (per second, burst)."""
+    count, _, period = rate.partition("/")
+    return int(count) / PERIODS[period], int(count)
+
+
+def bucket(scope: str, ident) -> Bucket:
+    """Bucket for a scope configured in ``settings.RATE_LIMITS``."""
+    rate, burst = parse_rate(settings.RATE_LIMITS[scope])
+    return Bucket(f"{KEY_PREFIX}{scope}:{ident}", rate, burst)
+
+
+def _args(buckets, cost):
+    keys = [b.key for b in buckets]
+    argv = [cost]
+    for b in buckets:
+        argv += [b.rate, b.burst]
+    return keys, argv
+
+
+_script = None
+
+
+def hit(*buckets: Bucket, cost: int = 1) -> float:
+    """
+    Take ``cost`` tokens from every bucket. Returns 0 when allowed, otherwise
+    the Retry-After seconds. Fails open if Valkey is unreachable.
+    """
+    global _script
+    if _script is None:
+        _script = get_valkey().register_script(TOKEN_BUCKET_SCRIPT)
+    try:
+        return float(_script(*_args(buckets, cost)))
+    except Exception:
+        logger.warning("Rate limit check failed; allowing request", exc_info=True)
+        return 0.0
+
+
+async def ahit(*buckets: Bucket, cost: int = 1) -> float:
+    """Async variant of ``hit`` for consumers and async views."""
+    keys, argv = _args(buckets, cost)
+    script = get_async_valkey().register_script(TOKEN_BUCKET_SCRIPT)
+    try:
+        return float(await script(keys, argv))
+    except Exception:
+        logger.warning("Rate limit check failed; allowing request", exc_info=True)
+        return 0.0
+
+
+def client_ip(meta) -> str:
+    # nginx passes the client address in X-Real-IP
+    return meta.get("HTTP_X_REAL_IP") or meta.get("REMOTE_ADDR", "")
+
+
+# (bucket keys) -> [tokens left, usable until, last lease time]
+_leases = {}
+_leases_lock = threading.Lock()
+
+
+def _spend_lease(buckets):
+    """Spend a locally leased token if there is one; else return the batch size to lease."""
+    keys = tuple(b.key for b in buckets)
+    now = time.monotonic()
+    with _leases_lock:
+        lease = _leases.get(keys)
+        if lease is not None and lease[0] > 0 and lease[1] > now:
+            lease[0] -= 1
+            return 0
+        if lease is None or now - lease[2] > LEASE_TTL:
+            # quiet key: take exactly one token so nothing is stranded here
+            return 1
+        return max(1, min(settings.RATE_LIMIT_LEASE, min(b.burst for b in buckets) // 4))
+
+
+def _store_lease(buckets, granted):
+    keys = tuple(b.key for b in buckets)
+    now = time.monotonic()
+    with _leases_lock:
+        if len(_leases) > 10000:
+            for k in [k for k, lease in _leases.items() if now - lease[2] > LEASE_TTL]:
+                del _leases[k]
+        _leases[keys] = [granted - 1, now + LEASE_TTL, now]
+
+
+_lease_script = None
+
+
+def hit_leased(*buckets: Bucket) -> float:
+    """Like ``hit`` (cost 1), but spending tokens leased in batches by busy clients."""
+    global _lease_script
+    want = _spend_lease(buckets)
+    if not want:
+        return 0.0
+    if _lease_script is None:
+        _lease_script = get_valkey().register_script(LEASE_SCRIPT)
+    try:
+        granted, wait = _lease_script(*_args(buckets, want))
+    except Exception:
+        logger.warning("Rate limit check failed; allowing request", exc_info=True)
+        return 0.0
+    if not granted:
+        return float(wait)
+    _store_lease(buckets, granted)
+    return 0.0
+
+
+async def ahit_leased(*buckets: Bucket) -> float:
+    """Async variant of ``hit_leased``."""
+    want = _spend_lease(buckets)
+    if not want:
+        return 0.0
+    script = get_async_valkey().register_script(LEASE_SCRIPT)
+    try:
+        granted, wait = await script(*_args(buckets, want))
+    except Exception:
+        logger.warning("Rate limit check failed; allowing request", exc_info=True)
+        return 0.0
+    if not granted:
+        return float(wait)
+    _store_lease(buckets, granted)
+    return 0.0
+
+
+def scope_client_ip(scope) -> str:
+    """client_ip for an ASGI (WebSocket) scope."""
+    headers = dict(scope.get("headers") or ())
+    real_ip = headers.get(b"x-real-ip")
+    if real_ip:
+        return real_ip.decode()
+    client = scope.get("client")
+    return client[0] if client else ""
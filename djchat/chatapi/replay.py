@@ -0,0 +1,76 @@
+"""
+Per-room event sequence numbers and replay buffer.
+
+Every room event gets a monotonic ``event_seq`` from a Valkey counter and is
+appended to a capped Valkey stream (entry id ``<event_seq>-0``). A reconnecting
+socket sends its last seen ``event_seq`` per room and RoomConsumer replays the
+missed events from the stream; only when the gap is larger than the buffer
+does the client need to resync over REST (``rooms/<id>/changes/``).
+"""
+import json
+
+from django.conf import settings
+
+from .valkey import get_async_valkey, get_valkey
+
+# KEYS: seq counter, stream. ARGV: event json, maxlen, ttl, pub/sub channel or "".
+# Stamps the event, buffers it and (optionally) publishes it in one round trip.
+RECORD_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+local data = '{"event_seq":' .. seq .. ',' .. string.sub(ARGV[1], 2)
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], seq .. '-0', 'e', data)
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+if ARGV[4] ~= '' then
+    redis.call('PUBLISH', ARGV[4], data)
+end
+return data
+"""
+
+
+def seq_key(room_id) -> str:
+    # hash tag keeps a room's keys in one slot on a cluster
+    return f"djchat:{{room:{room_id}}}:seq"
+
+
+def stream_key(room_id) -> str:
+    return f"djchat:{{room:{room_id}}}:events"
+
+
+_script = None
+
+
+def record(room_id, event: dict, channel: str = "") -> dict:
+    """Stamp ``event`` with the next event_seq and buffer it; publish to ``channel`` if given."""
+    global _script
+    if _script is None:
+        _script = get_valkey().register_script(RECORD_SCRIPT)
+    data = _script(
+        [seq_key(room_id), stream_key(room_id)],
+        [
+            json.dumps(event),
+            settings.CHAT_REPLAY_BUFFER,
+            settings.CHAT_REPLAY_TTL,
+            channel,
+        ],
+    )
+    return json.loads(data)
+
+
+async def read_since(room_id, last_seq: int):
+    """
+    Events with event_seq > last_seq, oldest first. Returns None when some of
+    them are no longer buffered and the client has to resync.
+    """
+    pipe = get_async_valkey().pipeline(transaction=False)
+    pipe.get(seq_key(room_id))
+    pipe.xrange(stream_key(room_id), min=f"{last_seq + 1}-0", max="+")
+    current, entries = await pipe.execute()
+    current = int(current or 0)
+    if last_seq > current:
+        # counter went backwards (Valkey data lost)
+        return None
+    if last_seq == current:
+        return []
+    if not entries or int(entries[0][0].split("-")[0]) != last_seq + 1:
+        return None
+    return [json.loads(fields["e"]) for _, fields in entries]
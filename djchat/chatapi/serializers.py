@@ -1,6 +1,10 @@
+import base64
+import binascii
+
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from .models import Room, Membership, Message
+from .events import publish_new_message
 from django.db import transaction
 # from django.core.exceptions import ObjectDoesNotExist
 # from django.contrib.auth.models import Permission, Group
@@ -16,10 +20,15 @@ class RegisterSerializer(serializers.ModelSerializer):
         fields = ("username", "password", "email")
 
     def create(self, validated):
-        u = User.objects.create_user(
-            username=validated["username"], email=validated.get("email")
+        u = User(
+            username=validated["username"],
+            email=User.objects.normalize_email(validated.get("email")),
         )
-        u.set_password(validated["password"])
+        if "password_hash" in validated:
+            # already hashed off the request path by RegisterView
+            u.password = validated["password_hash"]
+        else:
+            u.set_password(validated["password"])
         u.save()
         return u
 
@@ -30,6 +39,7 @@ class RoomCreateSerializer(serializers.Serializer):
         child=serializers.CharField(), allow_empty=True
     )
     is_private = serializers.BooleanField(default=True)
+    e2e = serializers.BooleanField(default=False)
 
     def create(self, validated):
         request = self.context["request"]
@@ -38,6 +48,7 @@ class RoomCreateSerializer(serializers.Serializer):
             room = Room.create_with_key(
                 name=validated.get("name", ""),
                 is_private=validated.get("is_private", True),
+                e2e=validated.get("e2e", False),
                 created_by=request.user,
             )
             # add creator membership
@@ -45,20 +56,58 @@ class RoomCreateSerializer(serializers.Serializer):
                 room=room, user=request.user, invited_by=request.user
             )
             # invite users by username — only add if exist
-            for uname in username_list:
-                try:
-                    u = User.objects.get(username=uname)
-                    # avoid double adding creator
-                    if u != request.user:
-                        Membership.objects.create(
-                            room=room, user=u, invited_by=request.user
-                        )
-                except User.DoesNotExist:
-                    # skip or collect errors; here we skip
-                    continue
+            invited = set(username_list) - {request.user.username}
+            _, self.unknown_usernames = room.add_members(
+                invited, invited_by=request.user
+            )
         return room
 
 
+class MembershipBulkSerializer(serializers.Serializer):
+    usernames = serializers.ListField(
+        child=serializers.CharField(), allow_empty=False
+    )
+
+
+class Base64Field(serializers.Field):
+    """Binary data as a base64 string."""
+    default_error_messages = {"invalid": "Must be base64 encoded."}
+
+    def to_internal_value(self, data):
+        try:
+            return base64.b64decode(data, validate=True)
+        except (TypeError, binascii.Error):
+            self.fail("invalid")
+
+    def to_representation(self, value):
+        return base64.b64encode(bytes(value)).decode()
+
+
+class E2EMessageSerializer(serializers.Serializer):
+    """Client-encrypted message content for E2E rooms, stored as is."""
+    ciphertext = Base64Field()
+    nonce = Base64Field()
+    key_version = serializers.IntegerField(min_value=1)
+
+    def validate_key_version(self, value):
+        if value > self.context["room"].key_version:
+            raise serializers.ValidationError("Unknown room key version")
+        return value
+
+
+class E2EFileSerializer(E2EMessageSerializer):
+    encrypted_filename = Base64Field()
+
+
+class MemberKeysSerializer(serializers.Serializer):
+    key_version = serializers.IntegerField(min_value=1)
+    wrapped_keys = serializers.DictField(child=Base64Field(), allow_empty=False)
+
+
+class PublicKeySerializer(serializers.Serializer):
+    public_key = serializers.CharField(max_length=8192)
+
+
 class MessageSerializer(serializers.ModelSerializer):
     plaintext = serializers.CharField(write_only=True, required=False)
 
@@ -82,29 +131,9 @@ class MessageSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Not a member")
         # plaintext comes in request.data['plaintext'] - server will encrypt it
         plaintext = self.context["request"].data.get("plaintext", "").encode()
-        room_key = room.get_room_key()
-        from .crypto import encrypt_with_room_key
-
-        ct, nonce = encrypt_with_room_key(room_key, plaintext)
-        msg = Message.objects.create(
-            room=room, sender=request.user, ciphertext=ct, nonce=nonce
-        )
+        msg = Message.create_encrypted(room, request.user, plaintext)
         # notify via channels (we'll implement consumer)
-        from asgiref.sync import async_to_sync
-        from channels.layers import get_channel_layer
-
-        channel_layer = get_channel_layer()
-        if channel_layer is not None:
-            async_to_sync(channel_layer.group_send)(
-                f"room_{room.id}",
-                {
-                    "type": "new.message",
-                    "room_id": str(room.id),
-                    "message_id": str(msg.id),
-                },
-            )
-        else:
-            print("Warning: No channel layer configured; skipping message notification.")
+        publish_new_message(room, msg)
         return msg
 
 
@@ -149,7 +178,6 @@ class RoomSerializer(serializers.ModelSerializer):
     created_by_username = serializers.CharField(
         source="created_by.username", read_only=True
     )
-    member_count = serializers.SerializerMethodField()
     member_usernames = serializers.SerializerMethodField()
 
     class Meta:
@@ -159,19 +187,29 @@ class RoomSerializer(serializers.ModelSerializer):
             "name",
             "description",
             "is_private",
+            "e2e",
+            "key_version",
             "created_by_username",
             "created_at",
             "updated_at",
             "member_count",
+            "message_count",
+            "last_message_at",
             "member_usernames",
             "memberships",
         )
-        read_only_fields = ("created_at", "updated_at", "created_by_username")
-
-    def get_member_count(self, obj):
-        """Return the total number of members in the room."""
-        return obj.memberships.count()
+        read_only_fields = (
+            "e2e",
+            "key_version",
+            "created_at",
+            "updated_at",
+            "created_by_username",
+            "member_count",
+            "message_count",
+            "last_message_at",
+        )
 
     def get_member_usernames(self, obj):
         """Return a list of all member usernames for quick access."""
-        return list(obj.memberships.values_list("user__username", flat=True))
+        # from the memberships prefetched for the room list, not one query per room
+        return [membership.user.username for membership in obj.memberships.all()]
@@ -0,0 +1,127 @@
+"""
+Worker cold start: warm-up when the app is ready, and the startup profile.
+
+``warm()`` runs from ChatapiConfig.ready (CHAT_WARM_STARTUP), so what every
+request needs is built once before the worker takes traffic rather than by
+its first requests: the master key MultiFernet, the OpenSSL AES-GCM bindings,
+the Valkey client and the channel layer. djchat/asgi.py also loads the
+URLconf (views, DRF, serializers) up front.
+
+``profile()`` starts a fresh interpreter that loads ``djchat.asgi`` and serves
+one request, and reports the time to that first response and, with
+``-X importtime``, the import time of every module (`manage.py profile_startup`).
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+
+
+def warm():
+    from channels.layers import get_channel_layer
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    from .models import _master_fernet
+    from .valkey import get_valkey
+
+    if settings.SERVER_MASTER_KEY:
+        _master_fernet()
+    # loads the OpenSSL bindings on the first use, not the first message
+    AESGCM(os.urandom(32)).encrypt(os.urandom(12), b"", None)
+    get_valkey()
+    get_channel_layer()
+
+
+def parse_importtime(stderr: str) -> list:
+    """(module, self seconds, cumulative seconds) from ``-X importtime`` output."""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # the header
+        self_us, cumulative_us, name = fields
+        modules.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return modules
+
+
+def profile(path="/api/rooms/", importtime=True) -> dict:
+    """
+    Cold-start a worker in a subprocess and time it: ``cold_start`` is from
+    spawning the process to the first response, ``load`` the part spent
+    loading djchat.asgi, ``first_request`` the request itself.
+    """
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", "from chatapi.startup import _serve_first; _serve_first()", path]
+    started = time.time()
+    child = subprocess.run(
+        command, cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=120
+    )
+    if child.returncode != 0:
+        raise RuntimeError(f"Worker failed to start:\n{child.stderr[-4000:]}")
+    report = json.loads(child.stdout.strip().splitlines()[-1])
+    report["cold_start"] = report.pop("responded_at") - started
+    report["imports"] = parse_importtime(child.stderr) if importtime else []
+    return report
+
+
+def _serve_first():
+    # runs in the profiled interpreter: load the ASGI app, serve sys.argv[1]
+    started = time.perf_counter()
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djchat.settings")
+    from djchat.asgi import application
+
+    loaded = time.perf_counter()
+    status = asyncio.run(_request(application, sys.argv[1]))
+    done = time.perf_counter()
+    print(
+        json.dumps(
+            {
+                "status": status,
+                "load": loaded - started,
+                "first_request": done - loaded,
+                "responded_at": time.time(),
+            }
+        )
+    )
+
+
+async def _request(application, path) -> int:
+    host = next((h for h in settings.ALLOWED_HOSTS if h not in ("*", "")), "localhost")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", host.lstrip(".").encode())],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+    body = [{"type": "http.request", "body": b"", "more_body": False}]
+    disconnected = asyncio.Event()
+    sent = []
+
+    async def receive():
+        if body:
+            return body.pop()
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await application(scope, receive, send)
+    disconnected.set()
+    return next(m["status"] for m in sent if m["type"] == "http.response.start")
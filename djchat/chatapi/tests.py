@@ -1,3 +1,778 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import zipfile
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import redis
+import redis.asyncio
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.signals import user_login_failed
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.core.files.uploadedfile import SimpleUploadedFile
+from cryptography.fernet import Fernet
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import (
+    dbrouter, directory, events, fanout, ratelimit, replay, startup, typing_indicators, valkey,
+)
+from .consumers import RoomConsumer
+from .management.commands.gc_attachments import Command as GcAttachments
+from .models import AttachmentBlob, FileAttachment, MemberRoomKey, Membership, Message, Room
+
+User = get_user_model()
+
+# one in-memory Valkey for the whole run, so the suite needs no services
+FAKE_VALKEY = fakeredis.FakeServer()
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+async def until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.01)
+
+
+class FakeValkeyMixin:
+    """Every Valkey client (sync and asyncio) talks to an empty FAKE_VALKEY."""
+
+    def setUp(self):
+        super().setUp()
+        for client_class, fake_class in (
+            (redis.Redis, fakeredis.FakeRedis),
+            (redis.asyncio.Redis, fakeredis.FakeAsyncRedis),
+        ):
+            patcher = mock.patch.object(
+                client_class, "from_url",
+                lambda url, fake_class=fake_class, **kwargs: fake_class(
+                    server=FAKE_VALKEY, **kwargs
+                ),
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for reset in (valkey.get_valkey.cache_clear, valkey._async_clients.clear):
+            reset()
+            self.addCleanup(reset)
+        fakeredis.FakeRedis(server=FAKE_VALKEY).flushall()
+        # tokens leased from the previous test's buckets
+        ratelimit._leases.clear()
+
+
+class ColdStartTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # a fresh worker process: imports, setup, warm-up and one request
+        cls.report = startup.profile(importtime=False)
+
+    def test_time_to_first_response(self):
+        self.assertEqual(self.report["status"], 401)
+        self.assertLess(self.report["cold_start"], settings.CHAT_COLD_START_BUDGET)
+
+    def test_urlconf_loaded_before_first_request(self):
+        # everything heavy happens while loading djchat.asgi
+        self.assertLess(self.report["first_request"], self.report["load"])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class RoomConsumerTests(FakeValkeyMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user("owner")
+        self.room = Room.create_with_key(name="r", created_by=self.owner)
+        Membership.objects.create(room=self.room, user=self.owner)
+        self.room_id = str(self.room.id)
+
+    def connect(self, user, query=""):
+        token = RefreshToken.for_user(user).access_token
+        return WebsocketCommunicator(
+            RoomConsumer.as_asgi(), f"/ws/rooms/?token={token}{query}"
+        )
+
+    async def subscribed(self, user, listeners=1, query=""):
+        """A connected socket of ``user``, once the room has ``listeners`` on this node."""
+        ws = self.connect(user, query)
+        await ws.connect()
+        await ws.send_json_to({"action": "subscribe", "room_id": self.room_id})
+        await until(lambda: fanout.get_hub().local_listeners(self.room_id) == listeners)
+        return ws
+
+    async def publish(self, message_id):
+        await sync_to_async(events.publish_room_event)(
+            self.room_id,
+            {"type": "new.message", "room_id": self.room_id, "message_id": message_id, "seq": 1},
+        )
+
+    def test_hub_delivers_one_publish_to_every_local_socket(self):
+        async def run():
+            sockets = [await self.subscribed(self.owner, n) for n in (1, 2, 3)]
+            # one Valkey subscription for the node, however many sockets
+            channel = fanout.room_channel(self.room_id)
+            self.assertEqual(
+                await valkey.get_async_valkey().pubsub_numsub(channel), [(channel, 1)]
+            )
+            await self.publish("m1")
+            for ws in sockets:
+                self.assertEqual((await ws.receive_json_from())["message_id"], "m1")
+                await ws.disconnect()
+            self.assertEqual(fanout.get_hub().local_listeners(self.room_id), 0)
+
+        asyncio.run(run())
+
+    def test_failed_subscribe_is_retried_by_the_next_listener(self):
+        async def run():
+            ws = self.connect(self.owner)
+            await ws.connect()
+            with (
+                mock.patch.object(
+                    redis.asyncio.client.PubSub, "subscribe",
+                    side_effect=redis.ConnectionError("Valkey is down"),
+                ),
+                self.assertLogs("chatapi.consumers", "WARNING"),
+            ):
+                await ws.send_json_to({"action": "subscribe", "room_id": self.room_id})
+                self.assertEqual(
+                    await ws.receive_json_from(),
+                    {"type": "error", "error": "unavailable", "room_id": self.room_id},
+                )
+            self.assertEqual(fanout.get_hub().local_listeners(self.room_id), 0)
+            await ws.disconnect()
+            # subscribes for real, not stuck behind the failed attempt
+            ws = await self.subscribed(self.owner)
+            await self.publish("m1")
+            self.assertEqual((await ws.receive_json_from(timeout=2))["message_id"], "m1")
+            await ws.disconnect()
+
+        asyncio.run(run())
+
+    def test_resume_replays_missed_events_in_order(self):
+        async def run():
+            for message_id in ("m1", "m2", "m3"):
+                await self.publish(message_id)
+            ws = self.connect(self.owner)
+            await ws.connect()
+            await ws.send_json_to({"action": "resume", "rooms": {self.room_id: 1}})
+            await self.publish("m4")
+            frames = [await ws.receive_json_from() for _ in range(3)]
+            self.assertEqual(
+                [(f["message_id"], f["event_seq"]) for f in frames],
+                [("m2", 2), ("m3", 3), ("m4", 4)],
+            )
+            self.assertTrue(await ws.receive_nothing(0.1))
+            await ws.disconnect()
+
+        asyncio.run(run())
+
+    def test_resume_past_the_buffer_asks_for_a_resync(self):
+        async def run():
+            for message_id in ("m1", "m2"):
+                await self.publish(message_id)
+            # the buffer expired (CHAT_REPLAY_TTL) but the counter went on
+            valkey.get_valkey().delete(replay.stream_key(self.room_id))
+            await self.publish("m3")
+            ws = self.connect(self.owner)
+            await ws.connect()
+            await ws.send_json_to({"action": "resume", "rooms": {self.room_id: 0}})
+            frame = await ws.receive_json_from()
+            self.assertEqual(
+                (frame["type"], frame["room_id"]), ("resync_required", self.room_id)
+            )
+            await ws.send_json_to({"action": "resume", "rooms": {self.room_id: "4"}})
+            self.assertEqual((await ws.receive_json_from())["error"], "invalid_request")
+            await ws.disconnect()
+
+        asyncio.run(run())
+
+    async def received(self, ws, count):
+        return [(await ws.receive_json_from())["n"] for _ in range(count)]
+
+    def test_clients_that_never_ack_get_every_frame(self):
+        async def run():
+            ws = await self.subscribed(self.owner)
+            for i in range(60):
+                await self.publish(f"m{i}")
+            self.assertEqual(await self.received(ws, 60), list(range(1, 61)))
+            await ws.disconnect()
+
+        asyncio.run(run())
+
+    @override_settings(CHAT_WS_ACK_WINDOW=2)
+    def test_opted_in_sockets_get_a_window_of_unacknowledged_frames(self):
+        async def run():
+            ws = await self.subscribed(self.owner, query="&acks=1")
+            for i in range(5):
+                await self.publish(f"m{i}")
+            self.assertEqual(await self.received(ws, 2), [1, 2])
+            self.assertTrue(await ws.receive_nothing(0.1))
+            # stale or out of range acks change nothing
+            for n in (0, 9, "2"):
+                await ws.send_json_to({"action": "ack", "n": n})
+            self.assertTrue(await ws.receive_nothing(0.1))
+            await ws.send_json_to({"action": "ack", "n": 2})
+            self.assertEqual(await self.received(ws, 2), [3, 4])
+            self.assertTrue(await ws.receive_nothing(0.1))
+            await ws.disconnect()
+
+        asyncio.run(run())
+
+    @override_settings(CHAT_WS_ACK_WINDOW=2)
+    def test_the_first_ack_turns_flow_control_on(self):
+        async def run():
+            ws = await self.subscribed(self.owner)
+            for i in range(3):
+                await self.publish(f"m{i}")
+            self.assertEqual(await self.received(ws, 3), [1, 2, 3])
+            await ws.send_json_to({"action": "ack", "n": 3})
+            for i in range(3, 6):
+                await self.publish(f"m{i}")
+            self.assertEqual(await self.received(ws, 2), [4, 5])
+            self.assertTrue(await ws.receive_nothing(0.1))
+            await ws.disconnect()
+
+        asyncio.run(run())
+
+    @override_settings(RATE_LIMITS={**settings.RATE_LIMITS, "ws_user": "3/hour"})
+    def test_fast_typing_leaves_tokens_for_subscribe(self):
+        other = Room.create_with_key(name="other", created_by=self.owner)
+        Membership.objects.create(room=other, user=self.owner)
+
+        async def run():
+            with mock.patch.object(typing_indicators, "report") as report:
+                ws = await self.subscribed(self.owner)
+                for _ in range(20):
+                    await ws.send_json_to({"action": "typing", "room_id": self.room_id})
+                await ws.send_json_to({"action": "subscribe", "room_id": str(other.id)})
+                await until(lambda: fanout.get_hub().local_listeners(str(other.id)) == 1)
+                # only the first keystroke got past the throttle to the buckets
+                self.assertEqual(report.call_count, 1)
+                self.assertTrue(await ws.receive_nothing(0.1))
+                await ws.disconnect()
+
+        asyncio.run(run())
+
+    def test_only_members_can_subscribe(self):
+        owner, room = self.owner, self.room
+        outsider = User.objects.create_user("outsider")
+
+        async def subscribe(user, room_id):
+            ws = self.connect(user)
+            await ws.connect()
+            await ws.send_json_to({"action": "subscribe", "room_id": room_id})
+            reply = None
+            if not await ws.receive_nothing(0.3):
+                reply = await ws.receive_json_from()
+            await ws.disconnect()
+            return reply
+
+        room_id = str(room.id)
+        self.assertIsNone(asyncio.run(subscribe(owner, room_id)))
+        for room_id in (room_id, "not-a-uuid"):
+            self.assertEqual(
+                asyncio.run(subscribe(outsider, room_id)),
+                {"type": "error", "error": "not_a_member", "room_id": room_id},
+            )
+
+
+@override_settings(CHAT_TYPING_TTL=0.2, CHAT_TYPING_INTERVAL=0.05)
+class TypingIndicatorTests(FakeValkeyMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.updates = []
+        patcher = mock.patch.object(
+            typing_indicators, "apublish_ephemeral_event",
+            side_effect=lambda room_id, event: self.updates.append(event["usernames"]),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_one_broadcaster_coalesces_a_room(self):
+        async def run():
+            await typing_indicators.report("r1", "bob")
+            await typing_indicators.report("r1", "alice")
+            # the first report started the broadcaster, the second joined it
+            self.assertEqual(len(typing_indicators._broadcasts), 1)
+            await until(lambda: not typing_indicators._broadcasts)
+
+        asyncio.run(run())
+        self.assertIn(["alice", "bob"], self.updates)
+        self.assertEqual(self.updates[-1], [])
+        # at most one update per interval until both entries expired
+        self.assertLess(len(self.updates), 0.2 / 0.05 + 3)
+
+    def test_valkey_errors_are_logged_not_raised(self):
+        async def run():
+            with mock.patch.object(
+                typing_indicators, "get_async_valkey", side_effect=redis.ConnectionError
+            ), self.assertLogs("chatapi.typing_indicators", "WARNING"):
+                await typing_indicators.report("r1", "bob")
+
+        asyncio.run(run())
+        self.assertEqual(self.updates, [])
+
+
+class MemberKeysTests(TransactionTestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner")
+        self.member = User.objects.create_user("member")
+        self.room = Room.create_with_key(name="r", created_by=self.owner, e2e=True)
+        for user in (self.owner, self.member):
+            Membership.objects.create(room=self.room, user=user)
+
+    def stored(self, version):
+        return dict(
+            MemberRoomKey.objects.filter(room=self.room, version=version).values_list(
+                "user__username", "wrapped_key"
+            )
+        )
+
+    def test_members_only_replace_their_own_key(self):
+        self.room.store_member_keys(self.owner, 1, {"owner": b"o1", "member": b"m1"})
+        skipped = self.room.store_member_keys(
+            self.member, 1, {"owner": b"evil", "member": b"m2", "nobody": b"x"}
+        )
+        self.assertEqual(skipped, ["nobody", "owner"])
+        self.assertEqual(
+            {k: bytes(v) for k, v in self.stored(1).items()}, {"owner": b"o1", "member": b"m2"}
+        )
+
+    def test_new_version_needs_creator_or_every_member(self):
+        with self.assertRaises(PermissionError):
+            self.room.store_member_keys(self.member, 2, {"member": b"m2"})
+        self.assertEqual(self.room.key_version, 1)
+        self.room.store_member_keys(self.member, 2, {"owner": b"o2", "member": b"m2"})
+        self.assertEqual(self.room.key_version, 2)
+        self.room.store_member_keys(self.owner, 3, {"owner": b"o3"})
+        self.assertEqual(self.room.key_version, 3)
+
+
+class TempMediaMixin:
+    """Uploaded files go to a temporary MEDIA_ROOT."""
+
+    def setUp(self):
+        super().setUp()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+class AttachmentDeletionTests(TempMediaMixin, TransactionTestCase):
+
+    def room_with_shared_attachments(self, creator):
+        room = Room.create_with_key(name="r", created_by=creator)
+        for _ in range(2):
+            message = Message.objects.create(room=room, sender=creator, ciphertext=b"x")
+            FileAttachment.create_deduplicated(
+                message, SimpleUploadedFile("a.txt", b"same"),
+                encrypted_filename=b"", content_type="text/plain",
+            )
+        self.assertEqual(AttachmentBlob.objects.get(room=room).ref_count, 2)
+        return room
+
+    def test_delete_room_and_creator(self):
+        owner = User.objects.create_user("owner")
+        self.room_with_shared_attachments(owner).delete()
+        self.room_with_shared_attachments(owner)
+        owner.delete()
+        self.assertFalse(Room.objects.exists())
+        self.assertFalse(AttachmentBlob.objects.exists())
+        self.assertFalse(FileAttachment.objects.exists())
+
+    def test_gc_sweeps_orphaned_blob_files_in_batches(self):
+        room = self.room_with_shared_attachments(User.objects.create_user("owner"))
+        kept = AttachmentBlob.objects.get(room=room).file.name
+        storage = AttachmentBlob._meta.get_field("file").storage
+        orphans = [storage.save(f"chat_blobs/orphan{i}", ContentFile(b"o")) for i in range(3)]
+        an_hour_ago = time.time() - 7200
+        for name in [kept, *orphans]:
+            os.utime(storage.path(name), (an_hour_ago, an_hour_ago))
+        with CaptureQueriesContext(connection) as queries:
+            removed = GcAttachments().sweep_files(batch_size=500)
+        self.assertEqual((removed, len(queries)), (3, 1))
+        self.assertTrue(storage.exists(kept))
+        self.assertFalse(any(storage.exists(name) for name in orphans))
+
+
+class TokenObtainTests(FakeValkeyMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        User.objects.create_user("alice", password="correct horse")
+
+    def test_form_and_json_logins(self):
+        form = self.client.post("/api/token/", {"username": "alice", "password": "correct horse"})
+        self.assertEqual(form.status_code, 200, form.content)
+        self.assertIn("access", form.json())
+        json_login = self.client.post(
+            "/api/token/", {"username": "alice", "password": "correct horse"},
+            content_type="application/json",
+        )
+        self.assertEqual(json_login.status_code, 200, json_login.content)
+
+    def test_failed_login_goes_through_the_backends(self):
+        failed = []
+
+        def receiver(sender, credentials, **kwargs):
+            failed.append(credentials["username"])
+
+        user_login_failed.connect(receiver)
+        self.addCleanup(user_login_failed.disconnect, receiver)
+        for username in ("alice", "nobody"):
+            response = self.client.post(
+                "/api/token/", {"username": username, "password": "wrong"}
+            )
+            self.assertEqual(response.status_code, 401)
+        self.assertEqual(failed, ["alice", "nobody"])
+
+
+@mock.patch("chatapi.replay.record")
+class KeyRotationTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner")
+        self.room = Room.create_with_key(name="r", created_by=self.owner)
+
+    def readable(self):
+        room = Room.objects.get(pk=self.room.pk)
+        return [m.decrypt(room) for m in Message.objects.filter(room=room).order_by("seq")]
+
+    def test_rotated_and_rewrapped_keys_keep_messages_readable(self, _):
+        Message.create_encrypted(self.room, self.owner, b"before")
+        self.room.rotate_room_key()
+        Message.create_encrypted(self.room, self.owner, b"after")
+        old_master, new_master = settings.SERVER_MASTER_KEY, Fernet.generate_key().decode()
+        with override_settings(SERVER_MASTER_KEY=new_master, SERVER_OLD_MASTER_KEYS=[old_master]):
+            call_command("rotate_keys", "--rewrap", stdout=StringIO())
+        with override_settings(SERVER_MASTER_KEY=new_master, SERVER_OLD_MASTER_KEYS=[]):
+            self.assertEqual(self.readable(), [b"before", b"after"])
+            call_command("rotate_keys", "--reencrypt", "--pause", "0", stdout=StringIO())
+            self.assertEqual(self.readable(), [b"before", b"after"])
+            self.assertEqual(
+                set(Message.objects.values_list("key_version", flat=True)), {2}
+            )
+
+    def test_rewrap_does_not_undo_a_concurrent_rotation(self, _):
+        stale = Room.objects.get(pk=self.room.pk)
+        self.room.rotate_room_key()
+        Message.create_encrypted(self.room, self.owner, b"new key")
+        stale.rewrap_keys()
+        self.assertEqual(stale.key_version, 2)
+        self.assertEqual(self.readable(), [b"new key"])
+
+
+@mock.patch("chatapi.replay.record")
+class PruneMessagesTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user("owner")
+        self.room = Room.create_with_key(name="r", created_by=self.owner)
+
+    def prune(self, *args):
+        call_command("prune_messages", "--pause", "0", *args, stdout=StringIO())
+
+    def test_tombstones_dont_count_towards_max_messages(self, _):
+        self.room.retention_max_messages = 2
+        self.room.save(update_fields=["retention_max_messages"])
+        for body in (b"1", b"2", b"3", b"4"):
+            Message.create_encrypted(self.room, self.owner, body)
+        Message.objects.get(seq=4).tombstone()
+        self.prune()
+        live = Message.objects.filter(deleted_at__isnull=True).order_by("seq")
+        self.assertEqual([m.decrypt() for m in live], [b"2", b"3"])
+
+    def test_sweep_files_checks_references_in_batches(self, _):
+        message = Message.create_encrypted(self.room, self.owner, b"x")
+        kept = FileAttachment.objects.create(
+            message=message, file=ContentFile(b"kept", name="kept.txt"),
+            encrypted_filename=b"", file_size=4, content_type="text/plain",
+        )
+        storage = FileAttachment._meta.get_field("file").storage
+        orphans = [storage.save(f"chat_files/orphan{i}.txt", ContentFile(b"o")) for i in range(3)]
+        an_hour_ago = time.time() - 7200
+        for name in [kept.file.name, *orphans]:
+            os.utime(storage.path(name), (an_hour_ago, an_hour_ago))
+        with CaptureQueriesContext(connection) as queries:
+            self.prune("--sweep-files")
+        lookups = [q for q in queries if "chatapi_fileattachment" in q["sql"]]
+        self.assertEqual(len(lookups), 1)
+        self.assertTrue(storage.exists(kept.file.name))
+        self.assertFalse(any(storage.exists(name) for name in orphans))
+
+
+class MessageChangesTests(FakeValkeyMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user("owner")
+        self.member = User.objects.create_user("member")
+        self.room = Room.create_with_key(name="r", created_by=self.owner)
+        for user in (self.owner, self.member):
+            Membership.objects.create(room=self.room, user=user)
+        self.api = APIClient()
+        self.api.force_authenticate(self.member)
+        self.url = f"/api/rooms/{self.room.id}/"
+        self.ids = [
+            self.api.post(f"{self.url}messages/", {"plaintext": text}, format="json").data["id"]
+            for text in ("one", "two", "three")
+        ]
+
+    def changes(self, since, limit=200):
+        response = self.api.get(f"{self.url}changes/", {"since": since, "limit": limit})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_edits_and_deletes_show_up_as_changes(self):
+        first, second, _ = self.ids
+        edited = self.api.patch(
+            f"{self.url}messages/{first}/", {"plaintext": "one!"}, format="json"
+        )
+        self.assertEqual(edited.data["plaintext"], "one!")
+        self.assertEqual(self.api.delete(f"{self.url}messages/{second}/").status_code, 204)
+
+        changes = self.changes(since=3)
+        self.assertEqual(changes["seq"], 5)
+        self.assertFalse(changes["has_more"])
+        self.assertEqual(
+            [(c["id"], c["seq"], c.get("plaintext"), c.get("deleted")) for c in changes["changes"]],
+            [(first, 4, "one!", None), (second, 5, None, True)],
+        )
+        self.assertEqual(self.changes(since=5), {"seq": 5, "has_more": False, "changes": []})
+        history = self.api.get(f"{self.url}messages/").data
+        self.assertEqual([m["plaintext"] for m in history], ["one!", "three"])
+        # a tombstone can't be edited or deleted again
+        self.assertEqual(self.api.delete(f"{self.url}messages/{second}/").status_code, 404)
+
+    def test_only_the_sender_edits_and_the_creator_also_deletes(self):
+        self.api.force_authenticate(self.owner)
+        message = f"{self.url}messages/{self.ids[0]}/"
+        self.assertEqual(
+            self.api.patch(message, {"plaintext": "x"}, format="json").status_code, 403
+        )
+        self.assertEqual(self.api.delete(message).status_code, 204)
+
+    def test_changes_are_paged_by_seq(self):
+        page = self.changes(since=0, limit=2)
+        self.assertEqual((page["seq"], page["has_more"]), (2, True))
+        page = self.changes(since=page["seq"], limit=2)
+        self.assertEqual((page["seq"], page["has_more"]), (3, False))
+
+
+class RoomListTests(FakeValkeyMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user("owner")
+        for name in ("alice", "bob"):
+            User.objects.create_user(name)
+        self.api = APIClient()
+        self.api.force_authenticate(self.owner)
+
+    def create_room(self, name, invited):
+        response = self.api.post(
+            "/api/rooms/", {"name": name, "invited_usernames": invited}, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.data["id"]
+
+    def list_rooms(self):
+        response = self.api.get("/api/rooms/")
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_lists_stored_counters_most_recent_first(self):
+        quiet = self.create_room("quiet", ["alice"])
+        busy = self.create_room("busy", ["alice", "bob"])
+        for text in ("one", "two"):
+            self.api.post(f"/api/rooms/{quiet}/messages/", {"plaintext": text}, format="json")
+
+        rooms = self.list_rooms()
+        self.assertEqual([room["id"] for room in rooms], [quiet, busy])
+        self.assertEqual(
+            [(room["member_count"], room["message_count"]) for room in rooms], [(2, 2), (3, 0)]
+        )
+        self.assertEqual(sorted(rooms[1]["member_usernames"]), ["alice", "bob", "owner"])
+
+    def test_query_count_does_not_grow_with_rooms(self):
+        self.create_room("first", ["alice", "bob"])
+        with CaptureQueriesContext(connection) as few:
+            self.list_rooms()
+        for i in range(5):
+            self.create_room(f"room {i}", ["alice", "bob"])
+        with CaptureQueriesContext(connection) as many:
+            self.assertEqual(len(self.list_rooms()), 6)
+        self.assertEqual(len(many), len(few))
+
+
+class RoomExportTests(FakeValkeyMixin, TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user("owner")
+        self.room = Room.create_with_key(name="r", created_by=self.owner)
+        Membership.objects.create(room=self.room, user=self.owner)
+        first = Message.create_encrypted(self.room, self.owner, b"one")
+        self.attachment = FileAttachment.objects.create(
+            message=first, file=ContentFile(b"data", name="a.txt"),
+            encrypted_filename=b"", file_size=4, content_type="text/plain",
+        )
+        Message.create_encrypted(self.room, self.owner, b"gone").tombstone()
+        Message.create_encrypted(self.room, self.owner, b"two")
+        self.api = APIClient()
+        self.api.force_authenticate(self.owner)
+        self.url = f"/api/rooms/{self.room.id}/export/"
+
+    def export(self, fmt):
+        response = self.api.get(self.url, {"as": fmt})
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content)
+
+    def test_ndjson_has_the_live_messages_oldest_first(self):
+        records = [json.loads(line) for line in self.export("ndjson").splitlines()]
+        self.assertEqual([r["plaintext"] for r in records], ["one", "two"])
+        self.assertEqual(
+            records[0]["attachments"][0]["path"], f"attachments/{self.attachment.id}.txt"
+        )
+
+    def test_zip_has_the_messages_and_the_attachment_files(self):
+        with zipfile.ZipFile(BytesIO(self.export("zip"))) as archive:
+            path = f"attachments/{self.attachment.id}.txt"
+            self.assertEqual(archive.namelist(), ["messages.ndjson", path])
+            self.assertEqual(archive.read(path), b"data")
+            self.assertEqual(len(archive.read("messages.ndjson").splitlines()), 2)
+
+    def test_rejects_unknown_formats_and_non_members(self):
+        self.assertEqual(self.api.get(self.url, {"as": "csv"}).status_code, 400)
+        self.api.force_authenticate(User.objects.create_user("stranger"))
+        self.assertEqual(self.api.get(self.url).status_code, 403)
+
+
+@override_settings(DATABASE_REPLICAS=["replica0", "replica1"], REPLICA_MAX_LAG=2)
+class ReplicaRoutingTests(FakeValkeyMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        # no health check cached from another test
+        for name, value in (("_healthy", []), ("_checked_at", float("-inf"))):
+            patcher = mock.patch.object(dbrouter, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @mock.patch("chatapi.models.ReplicaHeartbeat.write")
+    @mock.patch("chatapi.models.ReplicaHeartbeat.read")
+    def test_lagging_replicas_are_skipped(self, read, write):
+        lags = {"replica0": 0.5, "replica1": 5.0}
+        with mock.patch.object(dbrouter, "replica_lag", lambda alias, beat: lags[alias]):
+            self.assertEqual(dbrouter.healthy_replicas(), ["replica0"])
+        write.assert_called_once()
+
+    @override_settings(REPLICA_MAX_LAG=-1)
+    @mock.patch("chatapi.models.ReplicaHeartbeat.read")
+    def test_negative_max_lag_uses_every_replica(self, read):
+        self.assertEqual(dbrouter.healthy_replicas(), ["replica0", "replica1"])
+        read.assert_not_called()
+
+    @override_settings(DATABASE_REPLICAS=["replica0"], REPLICA_MAX_LAG=-1)
+    def test_writers_read_their_writes_from_the_primary(self):
+        self.assertEqual(dbrouter.choose_replica(7), "replica0")
+        dbrouter.mark_write(7)
+        self.assertIsNone(dbrouter.choose_replica(7))
+        self.assertEqual(dbrouter.choose_replica(8), "replica0")
+
+
+class MemberDirectoryTests(FakeValkeyMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        owner = User.objects.create_user("owner")
+        for name in ("alice", "bob", "carol", "dave"):
+            User.objects.create_user(name)
+        self.api = APIClient()
+        self.api.force_authenticate(owner)
+        room_id = self.api.post(
+            "/api/rooms/", {"name": "r", "invited_usernames": ["alice", "bob", "carol"]},
+            format="json",
+        ).data["id"]
+        self.url = f"/api/rooms/{room_id}/members/"
+
+    def usernames(self, **params):
+        page = self.api.get(self.url, params).data
+        return [member["username"] for member in page["results"]], page["next_cursor"]
+
+    def test_pages_by_username(self):
+        self.assertEqual(self.usernames(limit=2), (["alice", "bob"], "bob"))
+        self.assertEqual(self.usernames(limit=2, cursor="bob"), (["carol", "owner"], None))
+        self.assertEqual(self.usernames(q="CA"), (["carol"], None))
+
+    def test_pages_are_cached_until_the_members_change(self):
+        with mock.patch.object(directory, "load_page", wraps=directory.load_page) as load:
+            first = self.usernames()
+            self.assertEqual(self.usernames(), first)
+            self.assertEqual(load.call_count, 1)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.api.post(self.url, {"usernames": ["dave"]}, format="json")
+            self.assertEqual(self.usernames(), (["alice", "bob", "carol", "dave", "owner"], None))
+            self.assertEqual(load.call_count, 2)
+
+
+@override_settings(CHAT_NEW_MESSAGE_WINDOW_MS=50)
+class NewMessageCoalescingTests(FakeValkeyMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.room = SimpleNamespace(id=uuid.uuid4())
+        self.published = []
+        patcher = mock.patch.object(
+            events, "publish_room_event",
+            side_effect=lambda room_id, event: self.published.append(event),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # leave no flush pending for the flusher thread once Valkey is unpatched
+        self.addCleanup(self.wait, self.window_closed)
+
+    def post(self, seq):
+        events.publish_new_message(self.room, SimpleNamespace(id=f"m{seq}", seq=seq))
+
+    def wait(self, condition):
+        asyncio.run(until(condition))
+
+    def window_closed(self):
+        return not valkey.get_valkey().exists(events.window_key(self.room.id))
+
+    def summary(self):
+        return [
+            [m["message_id"] for m in e["messages"]] if e["type"] == "new.messages"
+            else e["message_id"]
+            for e in self.published
+        ]
+
+    def test_a_burst_costs_one_event_per_window(self):
+        for seq in range(1, 5):
+            self.post(seq)
+        self.wait(lambda: len(self.published) == 2)
+        self.assertEqual(self.summary(), ["m1", ["m2", "m3", "m4"]])
+        self.assertEqual(self.published[1]["seq"], 4)
+        # the window closes once a round goes by without messages
+        self.wait(self.window_closed)
+        self.post(5)
+        self.assertEqual(self.summary()[-1], "m5")
+
+    def test_the_next_publisher_flushes_an_orphaned_window(self):
+        # the process that opened the window dies before flushing it
+        with mock.patch.object(events._flusher, "schedule"):
+            self.post(1)
+            self.post(2)
+        time.sleep(0.15)
+        self.post(3)
+        self.wait(lambda: len(self.published) == 2)
+        self.assertEqual(self.summary(), ["m1", ["m2", "m3"]])
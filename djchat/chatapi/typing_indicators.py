@@ -0,0 +1,97 @@
+"""
+Typing indicators, coalesced per room and kept only in Valkey.
+
+Each room has a sorted set of typing usernames scored by expiry time. A
+"typing" report just refreshes the user's entry; whichever node first takes
+the room's tick lock runs the broadcaster, which publishes one event listing
+everyone who is typing every CHAT_TYPING_INTERVAL seconds and stops after the
+list has emptied. Fan-out is bounded by the interval, not by keystrokes, and
+nothing touches the database.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+from .events import apublish_ephemeral_event
+from .valkey import get_async_valkey
+
+logger = logging.getLogger(__name__)
+
+# KEYS: typing zset, tick lock. ARGV: username, typing (1/0), ttl ms, tick ms.
+# Returns 1 when the caller should start the room's broadcaster.
+REPORT_SCRIPT = """
+if ARGV[2] == '1' then
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+    redis.call('PEXPIRE', KEYS[1], ARGV[3])
+else
+    redis.call('ZREM', KEYS[1], ARGV[1])
+end
+if redis.call('SET', KEYS[2], '1', 'NX', 'PX', ARGV[4]) then
+    return 1
+end
+return 0
+"""
+
+# KEYS: typing zset, tick lock. ARGV: tick ms. Returns the current typers and
+# keeps the tick lock while there are any.
+FLUSH_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local typers = redis.call('ZRANGE', KEYS[1], 0, -1)
+if #typers > 0 then
+    redis.call('SET', KEYS[2], '1', 'PX', ARGV[1])
+else
+    redis.call('DEL', KEYS[2])
+end
+return typers
+"""
+
+
+def _keys(room_id):
+    return [f"djchat:{{room:{room_id}}}:typing", f"djchat:{{room:{room_id}}}:typing:tick"]
+
+
+def _tick_ms():
+    # lock outlives a few intervals so another node takes over if this one dies
+    return int(settings.CHAT_TYPING_INTERVAL * 3000)
+
+
+# running broadcasters; the event loop only keeps weak references to tasks
+_broadcasts = set()
+
+
+async def report(room_id, username, typing=True):
+    try:
+        start = await get_async_valkey().register_script(REPORT_SCRIPT)(
+            _keys(room_id),
+            [username, int(typing), int(settings.CHAT_TYPING_TTL * 1000), _tick_ms()],
+        )
+    except Exception:
+        # typing is best effort; it must not take the socket down with Valkey
+        logger.warning("Could not report typing in room %s", room_id, exc_info=True)
+        return
+    if start:
+        task = asyncio.create_task(_broadcast(room_id))
+        _broadcasts.add(task)
+        task.add_done_callback(_broadcasts.discard)
+
+
+async def _broadcast(room_id):
+    flush = get_async_valkey().register_script(FLUSH_SCRIPT)
+    try:
+        while True:
+            typers = await flush(_keys(room_id), [_tick_ms()])
+            await apublish_ephemeral_event(
+                room_id,
+                {"type": "typing.update", "room_id": str(room_id), "usernames": sorted(typers)},
+            )
+            if not typers:
+                break
+            await asyncio.sleep(settings.CHAT_TYPING_INTERVAL)
+    except Exception:
+        # the tick lock expires and the room's next report starts a new broadcaster
+        logger.warning("Typing broadcaster of room %s stopped", room_id, exc_info=True)
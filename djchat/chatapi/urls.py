@@ -4,28 +4,59 @@ from .views import (
     RegisterView,
     RoomCreateView,
     RoomDetailView,
+    RoomMembersView,
+    RoomKeysView,
     RoomMessagesView,
+    MessageDetailView,
+    RoomChangesView,
+    InboxView,
+    RoomExportView,
+    TokenObtainView,
+    UserKeyView,
     FileUploadView,
 )
-from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from rest_framework_simplejwt.views import TokenRefreshView
 
 urlpatterns = [
     # Authentication
     path("register/", RegisterView.as_view(), name="register"),
-    path("token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
+    path("token/", TokenObtainView.as_view(), name="token_obtain_pair"),
     path("token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
     # Rooms
     path("rooms/", RoomCreateView.as_view(), name="room_list_create"),
     path("rooms/<uuid:room_id>/", RoomDetailView.as_view(), name="room_detail"),
+    path(
+        "rooms/<uuid:room_id>/members/",
+        RoomMembersView.as_view(),
+        name="room_members",
+    ),
+    path("inbox/", InboxView.as_view(), name="inbox"),
+    path("rooms/<uuid:room_id>/keys/", RoomKeysView.as_view(), name="room_keys"),
     # Messages
     path(
         "rooms/<uuid:room_id>/messages/",
         RoomMessagesView.as_view(),
         name="room_messages",
     ),
+    path(
+        "rooms/<uuid:room_id>/messages/<uuid:message_id>/",
+        MessageDetailView.as_view(),
+        name="message_detail",
+    ),
+    path(
+        "rooms/<uuid:room_id>/changes/",
+        RoomChangesView.as_view(),
+        name="room_changes",
+    ),
+    path(
+        "rooms/<uuid:room_id>/export/",
+        RoomExportView.as_view(),
+        name="room_export",
+    ),
     # File uploads
     path(
         "rooms/<uuid:room_id>/upload/", FileUploadView.as_view(), name="file_upload"
     ),
     path("user/", CurrentUserView.as_view(), name="current_user"),
+    path("user/key/", UserKeyView.as_view(), name="user_key"),
 ]
@@ -0,0 +1,34 @@
+import asyncio
+import weakref
+from functools import lru_cache
+
+import redis
+import redis.asyncio
+from django.conf import settings
+
+
+@lru_cache(maxsize=1)
+def get_valkey() -> redis.Redis:
+    """Process wide synchronous Valkey client (thread safe connection pool)."""
+    return redis.Redis.from_url(settings.VALKEY_URL, decode_responses=True)
+
+
+def new_async_valkey() -> redis.asyncio.Redis:
+    """Fresh asyncio Valkey client.
+
+    asyncio connections are bound to the event loop that opened them, so the
+    caller owns the client and should keep one per loop.
+    """
+    return redis.asyncio.Redis.from_url(settings.VALKEY_URL, decode_responses=True)
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_valkey() -> redis.asyncio.Redis:
+    """Shared asyncio Valkey client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = new_async_valkey()
+    return client
@@ -1,35 +1,117 @@
+import json
+import math
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import aauthenticate
 from django.shortcuts import get_object_or_404 #render
+from django.db import transaction
+from django.db.models.functions import Coalesce
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 
 # Create your views here.
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
 from rest_framework.parsers import MultiPartParser, FormParser #, JSONParser
 from rest_framework_simplejwt.tokens import RefreshToken
-from .models import Room, Message, User, Membership, FileAttachment
+from .models import (
+    Room,
+    Message,
+    User,
+    FileAttachment,
+    MemberRoomKey,
+    UserPublicKey,
+)
 from .serializers import (
     # MessageSerializer,
     UserSerializer,
     RoomSerializer,
     RoomCreateSerializer,
     RegisterSerializer,
+    MembershipBulkSerializer,
+    Base64Field,
+    E2EMessageSerializer,
+    E2EFileSerializer,
+    MemberKeysSerializer,
+    PublicKeySerializer,
 )
-from .crypto import decrypt_with_room_key, encrypt_with_room_key
+from .crypto import encrypt_with_room_key
+from . import directory, export
+from .dbrouter import reads_from_replica
+from .events import (
+    publish_members_changed,
+    publish_message_changed,
+    publish_new_message,
+)
+from .passwords import HashingBusy, ahash_password
+from .ratelimit import bucket, ahit, client_ip, hit, hit_leased
 
 
 # -------------------------------
-# 1. Register new user
+# 1. Register new user / obtain tokens
 # -------------------------------
-class RegisterView(APIView):
-    permission_classes = [AllowAny]
-
-    def post(self, request, *args, **kwargs):
-        serializer = RegisterSerializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
-        user = serializer.save()
+# These are async Django views rather than DRF ones: password hashing is awaited
+# on the hashing process pool, so a login storm doesn't tie up the workers
+# serving the rest of the API. Both are rate limited per IP (and per username).
+class AsyncAuthView(View):
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # token auth endpoints, like DRF's APIView, don't use session CSRF
+        return csrf_exempt(super().as_view(**initkwargs))
+
+
+def _request_data(request):
+    """The body as a dict, JSON or form-encoded like DRF's parsers; None if malformed."""
+    if request.content_type in ("application/x-www-form-urlencoded", "multipart/form-data"):
+        return request.POST.dict()
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _too_many_requests(retry_after):
+    response = JsonResponse(
+        {"detail": "Too many requests"}, status=status.HTTP_429_TOO_MANY_REQUESTS
+    )
+    response["Retry-After"] = str(math.ceil(retry_after))
+    return response
+
+
+def _hashing_busy():
+    response = JsonResponse(
+        {"detail": "Server busy, try again shortly"},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+    response["Retry-After"] = "1"
+    return response
+
+
+class RegisterView(AsyncAuthView):
+    async def post(self, request, *args, **kwargs):
+        retry_after = await ahit(bucket("register_ip", client_ip(request.META)))
+        if retry_after:
+            return _too_many_requests(retry_after)
+        data = _request_data(request)
+        if data is None:
+            return JsonResponse(
+                {"detail": "Invalid request body"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        serializer = RegisterSerializer(data=data)
+        if not await sync_to_async(serializer.is_valid)():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            password_hash = await ahash_password(serializer.validated_data["password"])
+        except HashingBusy:
+            return _hashing_busy()
+        user = await sync_to_async(serializer.save)(password_hash=password_hash)
         refresh = RefreshToken.for_user(user)  # type: ignore
-        return Response(
+        return JsonResponse(
             {
                 "user": UserSerializer(user).data,
                 "refresh": str(refresh),
@@ -39,18 +121,53 @@ class RegisterView(APIView):
         )
 
 
+class TokenObtainView(AsyncAuthView):
+    async def post(self, request, *args, **kwargs):
+        data = _request_data(request) or {}
+        username = data.get("username")
+        password = data.get("password")
+        if not isinstance(username, str) or not isinstance(password, str):
+            return JsonResponse(
+                {"detail": "username and password are required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        retry_after = await ahit(
+            bucket("login_ip", client_ip(request.META)),
+            bucket("login_user", username.lower()),
+        )
+        if retry_after:
+            return _too_many_requests(retry_after)
+
+        try:
+            # AUTHENTICATION_BACKENDS, the hash checked on the pool (chatapi/backends.py)
+            user = await aauthenticate(request, username=username, password=password)
+        except HashingBusy:
+            return _hashing_busy()
+        if user is None:
+            return JsonResponse(
+                {"detail": "No active account found with the given credentials"},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+
+        refresh = RefreshToken.for_user(user)  # type: ignore
+        return JsonResponse({"refresh": str(refresh), "access": str(refresh.access_token)})
+
+
 # -------------------------------
 # 2. Create chat room & List user's rooms
 # -------------------------------
 class RoomCreateView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @reads_from_replica
     def get(self, request):
-        """List all rooms where the user is a member"""
-        memberships = Membership.objects.filter(user=request.user).select_related(
-            "room"
+        """List all rooms where the user is a member, most recently active first"""
+        rooms = (
+            Room.objects.filter(memberships__user=request.user)
+            .select_related("created_by")
+            .prefetch_related("memberships__user", "memberships__invited_by")
+            .order_by(Coalesce("last_message_at", "created_at").desc(), "id")
         )
-        rooms = [m.room for m in memberships]
         serializer = RoomSerializer(rooms, many=True)
         return Response(serializer.data)
 
@@ -68,7 +185,9 @@ class RoomCreateView(APIView):
         serializer = RoomCreateSerializer(data=request.data, context={"request": request})
         serializer.is_valid(raise_exception=True)
         room = serializer.save()
-        return Response(RoomSerializer(room).data, status=status.HTTP_201_CREATED)
+        data = RoomSerializer(room).data
+        data["unknown_usernames"] = serializer.unknown_usernames
+        return Response(data, status=status.HTTP_201_CREATED)
 
 
 # -------------------------------
@@ -77,38 +196,258 @@ class RoomCreateView(APIView):
 class RoomDetailView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @reads_from_replica
     def get(self, request, room_id):
-        """Get room details with members"""
-        room = get_object_or_404(Room, id=room_id)
+        """
+        Get room details with summary counts; the members are listed, paged,
+        by GET rooms/<id>/members/.
+        """
+        room = get_object_or_404(Room.objects.select_related("created_by"), id=room_id)
         if not room.memberships.filter(user=request.user).exists():
             return Response(
                 {"detail": "Not a member of this room"}, status=status.HTTP_403_FORBIDDEN
             )
 
-        members = User.objects.filter(room_memberships__room=room)
         return Response(
             {
                 "id": str(room.id),
                 "name": room.name,
                 "description": room.description,
                 "is_private": room.is_private,
+                "e2e": room.e2e,
+                "key_version": room.key_version,
                 "created_by": room.created_by.username,
                 "created_at": room.created_at,
                 "updated_at": room.updated_at,
+                "member_count": room.member_count,
+                "message_count": room.message_count,
+                "last_message_at": room.last_message_at,
+            }
+        )
+
+
+# -------------------------------
+# 3b. Bulk add / remove room members
+# -------------------------------
+class RoomMembersView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, room_id):
+        """
+        Member directory, by username: ?q= username prefix, ?limit= (max 200),
+        ?cursor= the next_cursor of the previous page.
+        """
+        room = get_object_or_404(Room, id=room_id)
+        if not room.memberships.filter(user=request.user).exists():
+            return Response(
+                {"detail": "Not a member of this room"}, status=status.HTTP_403_FORBIDDEN
+            )
+        try:
+            limit = max(int(request.query_params.get("limit", 50)), 1)
+        except ValueError:
+            return Response(
+                {"error": "limit must be an integer"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        page = directory.member_page(
+            room,
+            prefix=request.query_params.get("q", ""),
+            cursor=request.query_params.get("cursor", ""),
+            limit=min(limit, directory.MAX_LIMIT),
+        )
+        return Response(page)
+
+    def post(self, request, room_id):
+        """
+        Add members to the room. Any member can invite.
+        Request body example:
+        {
+            "usernames": ["alice", "bob"]
+        }
+        """
+        room = get_object_or_404(Room, id=room_id)
+        if not room.memberships.filter(user=request.user).exists():
+            return Response(
+                {"detail": "Not a member of this room"}, status=status.HTTP_403_FORBIDDEN
+            )
+        serializer = MembershipBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            added, unknown = room.add_members(
+                serializer.validated_data["usernames"], invited_by=request.user
+            )
+        if added:
+            publish_members_changed(room, added_ids=[u.id for u in added])
+        return Response(
+            {
+                "added": [u.username for u in added],
+                "unknown_usernames": unknown,
+            }
+        )
+
+    def delete(self, request, room_id):
+        """
+        Remove members from the room. Only the room creator can remove others;
+        any member can remove themselves.
+        """
+        room = get_object_or_404(Room, id=room_id)
+        if not room.memberships.filter(user=request.user).exists():
+            return Response(
+                {"detail": "Not a member of this room"}, status=status.HTTP_403_FORBIDDEN
+            )
+        serializer = MembershipBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        usernames = serializer.validated_data["usernames"]
+        if room.created_by_id != request.user.id and set(usernames) != {
+            request.user.username
+        }:
+            return Response(
+                {"detail": "Only the room creator can remove other members"},
+                status=status.HTTP_403_FORBIDDEN,
+            )
+
+        with transaction.atomic():
+            removed_ids, unknown = room.remove_members(usernames)
+        if removed_ids:
+            publish_members_changed(room, removed_ids=removed_ids)
+        return Response({"removed": len(removed_ids), "unknown_usernames": unknown})
+
+
+# -------------------------------
+# 3c. E2E rooms: member public keys and wrapped room keys
+# -------------------------------
+class RoomKeysView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get_room(self, request, room_id):
+        room = get_object_or_404(Room, id=room_id, e2e=True)
+        if not room.memberships.filter(user=request.user).exists():
+            return None
+        return room
+
+    def get(self, request, room_id):
+        """
+        Members' public keys (to wrap the room key for them), whether they have
+        the current key version, and the caller's own wrapped keys.
+        """
+        room = self.get_room(request, room_id)
+        if room is None:
+            return Response(
+                {"detail": "Not a member"}, status=status.HTTP_403_FORBIDDEN
+            )
+        has_current = set(
+            MemberRoomKey.objects.filter(room=room, version=room.key_version).values_list(
+                "user_id", flat=True
+            )
+        )
+        public_keys = dict(
+            UserPublicKey.objects.filter(user__room_memberships__room=room).values_list(
+                "user_id", "public_key"
+            )
+        )
+        members = room.memberships.select_related("user").order_by("user__username")
+        my_keys = MemberRoomKey.objects.filter(room=room, user=request.user).order_by(
+            "version"
+        )
+        b64 = Base64Field()
+        return Response(
+            {
+                "key_version": room.key_version,
                 "members": [
-                    {"id": u.id, "username": u.username, "email": u.email}
-                    for u in members
+                    {
+                        "username": m.user.username,
+                        "public_key": public_keys.get(m.user_id),
+                        "has_current_key": m.user_id in has_current,
+                    }
+                    for m in members
+                ],
+                "my_keys": [
+                    {"version": k.version, "wrapped_key": b64.to_representation(k.wrapped_key)}
+                    for k in my_keys
                 ],
             }
         )
 
+    def post(self, request, room_id):
+        """
+        Upload room keys wrapped for members. Use key_version + 1 to start a new
+        room key, e.g. after removing someone (the room creator, or anyone
+        wrapping it for every member). Only your own key of a version can be
+        replaced; others who already have one are skipped.
+        Request body example:
+        {
+            "key_version": 2,
+            "wrapped_keys": {"alice": "<base64>", "bob": "<base64>"}
+        }
+        """
+        room = self.get_room(request, room_id)
+        if room is None:
+            return Response(
+                {"detail": "Not a member"}, status=status.HTTP_403_FORBIDDEN
+            )
+        serializer = MemberKeysSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            skipped = room.store_member_keys(
+                request.user,
+                serializer.validated_data["key_version"],
+                serializer.validated_data["wrapped_keys"],
+            )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except PermissionError as e:
+            return Response({"error": str(e)}, status=status.HTTP_403_FORBIDDEN)
+        return Response({"key_version": room.key_version, "skipped_usernames": skipped})
+
 
 # -------------------------------
 # 4. Fetch and send room messages
 # -------------------------------
+def message_data(request, room, m):
+    """
+    API representation of a message: decrypted, or for E2E rooms the stored
+    ciphertext as is (a bare tombstone if deleted).
+    """
+    if m.deleted_at is not None:
+        return {"id": str(m.id), "seq": m.seq, "deleted": True, "deleted_at": m.deleted_at}
+    msg_data = {
+        "id": str(m.id),
+        "seq": m.seq,
+        "sender": m.sender.username if m.sender else None,
+        "created_at": m.created_at,
+        "edited_at": m.edited_at,
+    }
+    if room.e2e:
+        b64 = Base64Field()
+        msg_data["ciphertext"] = b64.to_representation(m.ciphertext)
+        msg_data["nonce"] = b64.to_representation(m.nonce)
+        msg_data["key_version"] = m.key_version
+    else:
+        msg_data["plaintext"] = m.decrypt(room).decode()
+    # Include file attachments if any
+    attachments = list(m.attachments.all())
+    if attachments:
+        msg_data["attachments"] = [
+            {
+                "id": str(att.id),
+                "file_url": request.build_absolute_uri(att.file.url),
+                "file_size": att.file_size,
+                "content_type": att.content_type,
+            }
+            for att in attachments
+        ]
+        if room.e2e:
+            for item, att in zip(msg_data["attachments"], attachments):
+                item["encrypted_filename"] = Base64Field().to_representation(
+                    att.encrypted_filename
+                )
+    return msg_data
+
+
 class RoomMessagesView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @reads_from_replica
     def get(self, request, room_id):
         """Fetch decrypted message history for a room"""
         room = get_object_or_404(Room, id=room_id)
@@ -121,31 +460,13 @@ class RoomMessagesView(APIView):
         limit = int(request.query_params.get("limit", 100))
         offset = int(request.query_params.get("offset", 0))
 
-        msgs = Message.objects.filter(room=room).order_by("-created_at")[
-            offset : offset + limit
-        ]
-        room_key = room.get_room_key()
-        out = []
-        for m in msgs:
-            pt = decrypt_with_room_key(room_key, bytes(m.ciphertext), bytes(m.nonce))
-            msg_data = {
-                "id": str(m.id),
-                "sender": m.sender.username if m.sender else None,
-                "plaintext": pt.decode(),
-                "created_at": m.created_at,
-            }
-            # Include file attachments if any
-            if m.attachments.exists():
-                msg_data["attachments"] = [
-                    {
-                        "id": str(att.id),
-                        "file_url": request.build_absolute_uri(att.file.url),
-                        "file_size": att.file_size,
-                        "content_type": att.content_type,
-                    }
-                    for att in m.attachments.all()
-                ]
-            out.append(msg_data)
+        msgs = (
+            Message.objects.filter(room=room, deleted_at__isnull=True)
+            .select_related("sender")
+            .prefetch_related("attachments")
+            .order_by("-created_at")[offset : offset + limit]
+        )
+        out = [message_data(request, room, m) for m in msgs]
 
         return Response(out[::-1])  # Reverse to get chronological order
 
@@ -156,6 +477,21 @@ class RoomMessagesView(APIView):
             return Response(
                 {"detail": "Not a member"}, status=status.HTTP_403_FORBIDDEN
             )
+        retry_after = hit_leased(
+            bucket("message_user", request.user.id),
+            bucket("message_ip", client_ip(request.META)),
+            bucket("message_room", room.id),
+        )
+        if retry_after:
+            return _too_many_requests(retry_after)
+
+        if room.e2e:
+            # E2E: {"ciphertext", "nonce", "key_version"}, stored as sent
+            serializer = E2EMessageSerializer(data=request.data, context={"room": room})
+            serializer.is_valid(raise_exception=True)
+            msg = Message.create_opaque(room, request.user, **serializer.validated_data)
+            publish_new_message(room, msg)
+            return Response(message_data(request, room, msg), status=status.HTTP_201_CREATED)
 
         plaintext = request.data.get("plaintext", "")
         if not plaintext:
@@ -164,33 +500,16 @@ class RoomMessagesView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Encrypt message
-        room_key = room.get_room_key()
-        ct, nonce = encrypt_with_room_key(room_key, plaintext.encode())
-
-        # Create message
-        msg = Message.objects.create(
-            room=room, sender=request.user, ciphertext=ct, nonce=nonce
-        )
+        # Encrypt and create message
+        msg = Message.create_encrypted(room, request.user, plaintext.encode())
 
         # Notify via channels
-        from asgiref.sync import async_to_sync
-        from channels.layers import get_channel_layer
-
-        channel_layer = get_channel_layer()
-        if channel_layer is not None:
-            async_to_sync(channel_layer.group_send)(
-                f"room_{room.id}",
-                {
-                    "type": "new.message",
-                    "room_id": str(room.id),
-                    "message_id": str(msg.id),
-                },
-            )
+        publish_new_message(room, msg)
 
         return Response(
             {
                 "id": str(msg.id),
+                "seq": msg.seq,
                 "sender": request.user.username,
                 "plaintext": plaintext,
                 "created_at": msg.created_at,
@@ -199,6 +518,198 @@ class RoomMessagesView(APIView):
         )
 
 
+# -------------------------------
+# 4b. Edit / delete a message
+# -------------------------------
+class MessageDetailView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get_message(self, request, room_id, message_id):
+        msg = get_object_or_404(
+            Message.objects.select_related("room"),
+            id=message_id,
+            room_id=room_id,
+            deleted_at__isnull=True,
+        )
+        if not msg.room.memberships.filter(user=request.user).exists():
+            return None
+        return msg
+
+    def patch(self, request, room_id, message_id):
+        """
+        Edit your own message. Body: {"plaintext": "..."}, or in E2E rooms
+        {"ciphertext": "...", "nonce": "...", "key_version": 1}
+        """
+        msg = self.get_message(request, room_id, message_id)
+        if msg is None or msg.sender_id != request.user.id:
+            return Response(
+                {"detail": "You can only edit your own messages"},
+                status=status.HTTP_403_FORBIDDEN,
+            )
+        if msg.room.e2e:
+            serializer = E2EMessageSerializer(data=request.data, context={"room": msg.room})
+            serializer.is_valid(raise_exception=True)
+            msg.edit_opaque(**serializer.validated_data)
+            publish_message_changed(msg.room, msg)
+            return Response(message_data(request, msg.room, msg))
+        plaintext = request.data.get("plaintext", "")
+        if not plaintext:
+            return Response(
+                {"error": "Message plaintext is required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        msg.edit(plaintext.encode())
+        publish_message_changed(msg.room, msg)
+        return Response(message_data(request, msg.room, msg))
+
+    def delete(self, request, room_id, message_id):
+        """Delete a message for everyone: your own, or any message as room creator."""
+        msg = self.get_message(request, room_id, message_id)
+        if msg is None or request.user.id not in (msg.sender_id, msg.room.created_by_id):
+            return Response(
+                {"detail": "You cannot delete this message"},
+                status=status.HTTP_403_FORBIDDEN,
+            )
+        msg.tombstone()
+        publish_message_changed(msg.room, msg)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+# -------------------------------
+# 4c. Incremental sync: changes since a room sequence number
+# -------------------------------
+class RoomChangesView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, room_id):
+        """
+        New, edited and deleted messages with seq > ?since=<seq>, oldest first.
+        Repeat with the returned "seq" while "has_more" is true.
+        """
+        room = get_object_or_404(Room, id=room_id)
+        if not room.memberships.filter(user=request.user).exists():
+            return Response(
+                {"detail": "Not a member"}, status=status.HTTP_403_FORBIDDEN
+            )
+        try:
+            since = int(request.query_params.get("since", 0))
+            limit = min(int(request.query_params.get("limit", 200)), 1000)
+        except ValueError:
+            return Response(
+                {"error": "since and limit must be integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        msgs = list(
+            Message.objects.filter(room=room, seq__gt=since)
+            .select_related("sender")
+            .prefetch_related("attachments")
+            .order_by("seq")[: limit + 1]
+        )
+        has_more = len(msgs) > limit
+        msgs = msgs[:limit]
+        return Response(
+            {
+                "seq": msgs[-1].seq if msgs else max(since, room.change_seq),
+                "has_more": has_more,
+                "changes": [message_data(request, room, m) for m in msgs],
+            }
+        )
+
+
+# -------------------------------
+# 4d. Inbox: the user's rooms by activity, with the latest message
+# -------------------------------
+class InboxView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """
+        The user's rooms, most recently active first, each with its latest
+        message decrypted. Paginated with ?limit= (max 100) and ?offset=.
+        """
+        try:
+            limit = min(int(request.query_params.get("limit", 50)), 100)
+            offset = int(request.query_params.get("offset", 0))
+        except ValueError:
+            return Response(
+                {"error": "limit and offset must be integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # Room.last_message / last_message_at are maintained on write, so
+        # this never touches the Message table
+        rooms = list(
+            Room.objects.filter(memberships__user=request.user)
+            .annotate(last_activity=Coalesce("last_message_at", "created_at"))
+            .order_by("-last_activity", "id")[offset : offset + limit + 1]
+        )
+        has_more = len(rooms) > limit
+        rooms = rooms[:limit]
+
+        # one query for all previews, decrypted with each room's cached key
+        messages = (
+            Message.objects.filter(
+                id__in=[r.last_message_id for r in rooms if r.last_message_id]
+            )
+            .select_related("sender")
+            .prefetch_related("attachments")
+            .in_bulk()
+        )
+        results = []
+        for room in rooms:
+            msg = messages.get(room.last_message_id)
+            results.append(
+                {
+                    "id": str(room.id),
+                    "name": room.name,
+                    "is_private": room.is_private,
+                    "e2e": room.e2e,
+                    "last_activity": room.last_activity,
+                    "last_message": message_data(request, room, msg) if msg else None,
+                }
+            )
+        return Response({"has_more": has_more, "results": results})
+
+
+# -------------------------------
+# 4e. Streaming export of a room's history
+# -------------------------------
+class RoomExportView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, room_id):
+        """
+        The whole room history, streamed: ?as=ndjson (default, one message
+        per line) or ?as=zip (messages.ndjson + attachments/). Not ?format=,
+        which DRF keeps for picking a renderer.
+        """
+        room = get_object_or_404(Room, id=room_id)
+        if not room.memberships.filter(user=request.user).exists():
+            return Response(
+                {"detail": "Not a member"}, status=status.HTTP_403_FORBIDDEN
+            )
+        fmt = request.query_params.get("as", "ndjson")
+        if fmt not in ("ndjson", "zip"):
+            return Response(
+                {"error": "as must be ndjson or zip"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        retry_after = hit(bucket("export_user", request.user.id))
+        if retry_after:
+            return _too_many_requests(retry_after)
+
+        if fmt == "zip":
+            chunks, content_type = export.zip_chunks(room), "application/zip"
+        else:
+            chunks, content_type = export.ndjson_chunks(room), "application/x-ndjson"
+        if isinstance(request._request, ASGIRequest):
+            chunks = export.aiter_in_thread(chunks)
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="room-{room.id}.{fmt}"'
+        return response
+
+
 # -------------------------------
 # 5. File upload endpoint
 # -------------------------------
@@ -212,12 +723,22 @@ class FileUploadView(APIView):
         Send as multipart/form-data with:
         - file: the file to upload
         - plaintext: optional message text
+        In E2E rooms the file is encrypted by the client, and instead of
+        plaintext send base64 ciphertext, nonce, key_version (the message
+        text) and encrypted_filename.
         """
         room = get_object_or_404(Room, id=room_id)
         if not room.memberships.filter(user=request.user).exists():
             return Response(
                 {"detail": "Not a member"}, status=status.HTTP_403_FORBIDDEN
             )
+        retry_after = hit_leased(
+            bucket("upload_user", request.user.id),
+            bucket("upload_ip", client_ip(request.META)),
+            bucket("message_room", room.id),
+        )
+        if retry_after:
+            return _too_many_requests(retry_after)
 
         uploaded_file = request.FILES.get("file")
         if not uploaded_file:
@@ -225,42 +746,40 @@ class FileUploadView(APIView):
                 {"error": "No file provided"}, status=status.HTTP_400_BAD_REQUEST
             )
 
+        if room.e2e:
+            serializer = E2EFileSerializer(data=request.data, context={"room": room})
+            serializer.is_valid(raise_exception=True)
+            data = dict(serializer.validated_data)
+            encrypted_filename = data.pop("encrypted_filename")
+            msg = Message.create_opaque(room, request.user, **data)
+            FileAttachment.create_deduplicated(
+                msg,
+                uploaded_file,
+                encrypted_filename=encrypted_filename,
+                content_type="application/octet-stream",
+            )
+            publish_new_message(room, msg)
+            return Response(message_data(request, room, msg), status=status.HTTP_201_CREATED)
+
         plaintext = request.data.get("plaintext", "")
 
         # Create message
         room_key = room.get_room_key()
         message_text = plaintext or f"Shared file: {uploaded_file.name}"
-        ct, nonce = encrypt_with_room_key(room_key, message_text.encode())
-
-        msg = Message.objects.create(
-            room=room, sender=request.user, ciphertext=ct, nonce=nonce
-        )
+        msg = Message.create_encrypted(room, request.user, message_text.encode())
 
         # Encrypt filename and save file
         filename_ct, _ = encrypt_with_room_key(room_key, uploaded_file.name.encode())
 
-        attachment = FileAttachment.objects.create(
-            message=msg,
-            file=uploaded_file,
+        attachment = FileAttachment.create_deduplicated(
+            msg,
+            uploaded_file,
             encrypted_filename=filename_ct,
-            file_size=uploaded_file.size,
             content_type=uploaded_file.content_type or "application/octet-stream",
         )
 
         # Notify via channels
-        from asgiref.sync import async_to_sync
-        from channels.layers import get_channel_layer
-
-        channel_layer = get_channel_layer()
-        if channel_layer is not None:
-            async_to_sync(channel_layer.group_send)(
-                f"room_{room.id}",
-                {
-                    "type": "new.message",
-                    "room_id": str(room.id),
-                    "message_id": str(msg.id),
-                },
-            )
+        publish_new_message(room, msg)
 
         return Response(
             {
@@ -295,4 +814,24 @@ class CurrentUserView(APIView):
                 "username": user.username,
                 "email": user.email,
             }
-        )
\ No newline at end of file
+        )
+
+
+# -------------------------------
+# 6b. Current user's public key (for E2E rooms)
+# -------------------------------
+class UserKeyView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        key = UserPublicKey.objects.filter(user=request.user).first()
+        return Response({"public_key": key.public_key if key else None})
+
+    def put(self, request):
+        """Set your public key. Body: {"public_key": "..."}"""
+        serializer = PublicKeySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        UserPublicKey.objects.update_or_create(
+            user=request.user, defaults=serializer.validated_data
+        )
+        return Response(serializer.validated_data)
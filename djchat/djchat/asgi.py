@@ -18,15 +18,18 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djchat.settings")
 django_asgi_app = get_asgi_application()
 #from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
+from django.urls import get_resolver
 from chatapi.routing import websocket_urlpatterns
 
+# Import the URLconf (views, DRF, serializers) now, not on the first request
+get_resolver().url_patterns
+
 # Define the ASGI application
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,  # Handles normal HTTP requests
-        "websocket": AuthMiddlewareStack(  # Handles WebSocket connections
-            URLRouter(websocket_urlpatterns)
-        ),
+        # RoomConsumer authenticates with the JWT in the query string, so no
+        # cookie/session lookups (AuthMiddlewareStack) on every connect
+        "websocket": URLRouter(websocket_urlpatterns),
     }
 )
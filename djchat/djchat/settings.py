@@ -26,6 +26,9 @@ load_dotenv(os.path.join(BASE_DIR, ".env"))
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.getenv("SECRET_KEY")
 SERVER_MASTER_KEY = os.getenv("SERVER_MASTER_KEY")
+# Retired master keys (comma separated) still accepted for unwrapping room keys
+# while `manage.py rotate_keys --rewrap` moves them to SERVER_MASTER_KEY
+SERVER_OLD_MASTER_KEYS = [k for k in os.getenv("SERVER_OLD_MASTER_KEYS", "").split(",") if k]
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True if os.getenv("DJANGO_DEBUG", "False") == 'True' else False
 
@@ -82,16 +85,72 @@ WSGI_APPLICATION = "djchat.wsgi.application"
 
 #CORS_ALLOW_ALL_ORIGINS = True
 
+# Valkey (Redis compatible) connection shared by the channel layer and chatapi
+VALKEY_URL = os.getenv(
+    "VALKEY_URL", f"redis://:{os.getenv('VALKEY_REDIS_PASSWORD')}@127.0.0.1:6380/0"
+)
+
 # Channels layer (use Redis in prod)
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-                    "hosts": [f"redis://:{os.getenv('VALKEY_REDIS_PASSWORD')}@127.0.0.1:6380/0"], 
+                    "hosts": [VALKEY_URL], 
+                    # per-channel buffer size and message expiry (seconds);
+                    # full channels drop new messages instead of growing Valkey
+                    "capacity": int(os.getenv("CHANNEL_LAYER_CAPACITY", "100")),
+                    "expiry": int(os.getenv("CHANNEL_LAYER_EXPIRY", "60")),
+                    "group_expiry": int(os.getenv("CHANNEL_LAYER_GROUP_EXPIRY", "86400")),
+                    # WebSocket consumer channels ("specific..." names) get their own cap
+                    "channel_capacity": {
+                        r"^specific\..*": int(os.getenv("CHANNEL_LAYER_CONSUMER_CAPACITY", "200")),
+                    },
         },
     }
 }
 
+# Node-local fan-out: each ASGI process subscribes once per active room over
+# Valkey pub/sub and dispatches to its local consumers in memory.
+# Set to False to fall back to plain channel layer group_send.
+CHAT_FANOUT_HUB = os.getenv("CHAT_FANOUT_HUB", "True") == "True"
+
+# Room events kept per room in a capped Valkey stream for WebSocket resume,
+# and how long (seconds) an idle room's buffer is kept
+CHAT_REPLAY_BUFFER = int(os.getenv("CHAT_REPLAY_BUFFER", "1000"))
+CHAT_REPLAY_TTL = int(os.getenv("CHAT_REPLAY_TTL", "86400"))
+
+# Coalesce new-message events per room: after a message is published, the
+# messages posted in the next N milliseconds go out as one "new.messages"
+# event (0 disables)
+CHAT_NEW_MESSAGE_WINDOW_MS = int(os.getenv("CHAT_NEW_MESSAGE_WINDOW_MS", "0"))
+
+# Per-connection outgoing queue for RoomConsumer, and what to do when a slow
+# client fills it: "coalesce" (one summary frame per room), "drop_oldest", or
+# "disconnect" (close with 4008, the client reconnects and resumes)
+CHAT_WS_SEND_QUEUE = int(os.getenv("CHAT_WS_SEND_QUEUE", "200"))
+CHAT_WS_SLOW_POLICY = os.getenv("CHAT_WS_SLOW_POLICY", "coalesce")
+# Unacknowledged frames a socket may have in flight, for clients that opted
+# in with ?acks=1 or their first {"action": "ack", "n": <n of the last frame>};
+# until they ack the rest waits in the queue above (0, the default, is off)
+CHAT_WS_ACK_WINDOW = int(os.getenv("CHAT_WS_ACK_WINDOW", "0"))
+
+# Typing indicators (seconds): how long a report lasts, the minimum gap between
+# reports per connection and room, and how often a room's typers are broadcast
+CHAT_TYPING_TTL = float(os.getenv("CHAT_TYPING_TTL", "5"))
+CHAT_TYPING_THROTTLE = float(os.getenv("CHAT_TYPING_THROTTLE", "2"))
+CHAT_TYPING_INTERVAL = float(os.getenv("CHAT_TYPING_INTERVAL", "1"))
+
+# Member directory pages (GET rooms/<id>/members/) are cached this long in
+# seconds; membership changes invalidate them right away
+MEMBER_DIRECTORY_TTL = int(os.getenv("MEMBER_DIRECTORY_TTL", "300"))
+
+# Build the channel layer, crypto objects and Valkey client when the app is
+# ready (chatapi/startup.py) instead of on the first requests; see
+# `manage.py profile_startup`. CHAT_COLD_START_BUDGET caps the time to the first
+# response in chatapi/tests.py (seconds).
+CHAT_WARM_STARTUP = os.getenv("CHAT_WARM_STARTUP", "True") == "True"
+CHAT_COLD_START_BUDGET = float(os.getenv("CHAT_COLD_START_BUDGET", "5"))
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
@@ -102,6 +161,28 @@ DATABASES = {
     }
 }
 
+# Read replicas for the read-only views (chatapi.dbrouter). DB_REPLICAS is a
+# comma-separated list of SQLite files, e.g. a copy of db.sqlite3 for local
+# testing; for other engines add the aliases to DATABASES and DATABASE_REPLICAS.
+DATABASE_REPLICAS = []
+for i, path in enumerate(p for p in os.getenv("DB_REPLICAS", "").split(",") if p.strip()):
+    alias = f"replica{i + 1}"
+    DATABASES[alias] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": path.strip(),
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_REPLICAS.append(alias)
+# users read from the primary this long after a write (read-your-writes)
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+# replicas further behind than this are skipped, checked every REPLICA_LAG_CHECK s
+# (negative: no lag check, every replica is used, e.g. a static copy for testing)
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "2"))
+REPLICA_LAG_CHECK = float(os.getenv("REPLICA_LAG_CHECK", "1"))
+if DATABASE_REPLICAS:
+    DATABASE_ROUTERS = ["chatapi.dbrouter.ReplicaRouter"]
+    MIDDLEWARE.append("chatapi.dbrouter.StickyWritesMiddleware")
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
         "rest_framework_simplejwt.authentication.JWTAuthentication",
@@ -121,6 +202,41 @@ SIMPLE_JWT = {
     "ALGORITHM": "HS256",
 }
 
+# Password hashing runs in a bounded process pool (chatapi/passwords.py) so login
+# bursts don't starve API workers. Hashes are upgraded on login when the cost changes.
+AUTH_HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", "2"))
+AUTH_HASH_MAX_PENDING = int(os.getenv("AUTH_HASH_MAX_PENDING", "64"))
+AUTH_PBKDF2_ITERATIONS = int(os.getenv("AUTH_PBKDF2_ITERATIONS", "1000000"))
+# ModelBackend that awaits the pool on the async path (login goes through aauthenticate)
+AUTHENTICATION_BACKENDS = ["chatapi.backends.PooledModelBackend"]
+
+PASSWORD_HASHERS = [
+    "chatapi.passwords.ConfigurablePBKDF2PasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+    "django.contrib.auth.hashers.ScryptPasswordHasher",
+]
+
+# Valkey token-bucket limits (chatapi/ratelimit.py), "count/period"
+RATE_LIMITS = {
+    "login_ip": os.getenv("RATE_LIMIT_LOGIN_IP", "30/min"),
+    "login_user": os.getenv("RATE_LIMIT_LOGIN_USER", "10/min"),
+    "register_ip": os.getenv("RATE_LIMIT_REGISTER_IP", "10/hour"),
+    # message posts and uploads share the per-room bucket
+    "message_user": os.getenv("RATE_LIMIT_MESSAGE_USER", "60/min"),
+    "message_ip": os.getenv("RATE_LIMIT_MESSAGE_IP", "120/min"),
+    "message_room": os.getenv("RATE_LIMIT_MESSAGE_ROOM", "600/min"),
+    "upload_user": os.getenv("RATE_LIMIT_UPLOAD_USER", "20/min"),
+    "upload_ip": os.getenv("RATE_LIMIT_UPLOAD_IP", "40/min"),
+    "export_user": os.getenv("RATE_LIMIT_EXPORT_USER", "10/hour"),
+    # WebSocket actions (subscribe, resume, typing, ...)
+    "ws_user": os.getenv("RATE_LIMIT_WS_USER", "120/min"),
+    "ws_ip": os.getenv("RATE_LIMIT_WS_IP", "300/min"),
+}
+# most tokens a process leases at once for a busy client (see hit_leased)
+RATE_LIMIT_LEASE = int(os.getenv("RATE_LIMIT_LEASE", "5"))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -161,6 +277,17 @@ STATIC_ROOT = os.getenv("DJANGO_STATIC_ROOT", BASE_DIR / "staticfiles")
 # Media files (User uploaded files)
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.getenv("DJANGO_MEDIA_ROOT", BASE_DIR / "media")
+
+# Compress message bodies with zstd before encryption (needs the optional
+# zstandard package); dictionaries come from `manage.py train_dictionaries`
+CHAT_COMPRESSION = os.getenv("CHAT_COMPRESSION", "True") == "True"
+CHAT_COMPRESSION_LEVEL = int(os.getenv("CHAT_COMPRESSION_LEVEL", "3"))
+
+# Global message retention, enforced by `manage.py prune_messages`.
+# Rooms can override with Room.retention_days / Room.retention_max_messages.
+CHAT_RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "0")) or None
+CHAT_RETENTION_MAX_MESSAGES = int(os.getenv("CHAT_RETENTION_MAX_MESSAGES", "0")) or None
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 